@@ -1,11 +1,26 @@
 from cmd import Cmd
-from Bio import pairwise2 as p
+from functools import lru_cache
 import os
-import json
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from Bio.SubsMat.MatrixInfo import blosum100 as matrix
+from HLA_retriever import AlleleStore, gapless_score
+
+#Bio, numpy, matplotlib and seaborn are only imported when first needed, so that the prompt shows up straight away
+
+
+def substitution_matrix():
+    from Bio.SubsMat.MatrixInfo import blosum100
+    return blosum100
+
+
+@lru_cache(maxsize=128)
+def align_sequences(seq1, seq2):
+    """Global alignment of two sequences, cached so that setting previously compared alleles again is instant. When the
+    gapless alignment is certain to be the best one, the alignment itself is skipped."""
+    score = gapless_score(seq1, seq2, substitution_matrix(), -10, -0.5)
+    if score is not None:
+        return (seq1, seq2, score, 0, len(seq1))
+    from Bio import pairwise2 as p
+    return p.align.globalds(seq1, seq2, substitution_matrix(), -10, -0.5, one_alignment_only = True)[0]
+
 
 class Alignment(Cmd):
     '''
@@ -27,13 +42,12 @@ class Alignment(Cmd):
         self.match = 0
         self.similarity = 0
         self.info = ""
-        self.fig = plt.figure()
+        self.fig = None
         self.data = []
         self.labels = []
-        plt.close()
+        self.rendered = False
         print(os.path.dirname(__file__))
-        with open("{}/databases/HLA_alleles.txt".format(os.path.dirname(__file__))) as json_file:
-            self.HLA_dict = json.load(json_file)
+        self.HLA_dict = AlleleStore("{}/databases/HLA_alleles.txt".format(os.path.dirname(__file__)))
 
     def do_setboth(self, alleles):
         """"Sets first and second alleles to be compared."""
@@ -81,8 +95,11 @@ class Alignment(Cmd):
             print('HLA sequence similarity between {} and {} is {}%'.format(self.alleles[0], self.alleles[1],
                                                                             self.similarity))
         elif 'mismatch' in args:
+            self.render()
             self.show_mismatch_info()
         elif 'heatmap' in args:
+            import matplotlib.pyplot as plt
+            self.render()
             self.create_heatmap()
             plt.show()
         else:
@@ -159,6 +176,7 @@ class Alignment(Cmd):
               .format(self.alleles[0], self.alleles[1], self.outputname, self.outputname))
 
     def matrix_refer(self, key):
+        matrix = substitution_matrix()
         if '-' in key:
             value = -10
         elif key not in matrix:
@@ -168,6 +186,7 @@ class Alignment(Cmd):
         return (value)
 
     def create_heatmap_data(self):
+        import numpy as np
         self.data = np.zeros([1, len(self.alignments[0])])
         for i in range(1):
             for j in range(self.alignments[4]):
@@ -178,6 +197,8 @@ class Alignment(Cmd):
             self.labels.append(char)
 
     def create_heatmap(self):
+        import matplotlib.pyplot as plt
+        import seaborn as sns
         sns.set(font_scale=0.7)
         plt.figure(num="{} vs {}".format(self.alleles[0], self.alleles[1]), figsize=(18, 2))
         plt.title('{} vs {}'.format(self.alleles[0], self.alleles[1]))
@@ -193,14 +214,20 @@ class Alignment(Cmd):
               .format(self.alleles[0], self.alleles[1], self.outputname, self.outputname))
 
     def align(self):
-        self.alignments = p.align.globalds(self.sequences[0], self.sequences[1], matrix, -10, -0.5, one_alignment_only = True)[0]
+        self.alignments = align_sequences(self.sequences[0], self.sequences[1])
         self.calc_similarity()
-        self.write_mismatch_info()
-        self.create_heatmap_data()
-        self.create_heatmap()
-        plt.close()
+        self.rendered = False
+
+    def render(self):
+        """Builds the mismatch text and heatmap data of the current alignment, only once it is asked for."""
+        if not self.rendered:
+            self.write_mismatch_info()
+            self.create_heatmap_data()
+            self.rendered = True
 
     def compare(self):
+        import matplotlib.pyplot as plt
+        self.render()
         self.show_mismatch_info()
         print('HLA sequence similarity between {} and {} is {}%'.format(self.alleles[0], self.alleles[1],
                                                                                self.similarity))
@@ -232,7 +259,11 @@ class Alignment(Cmd):
                       .format(self.outputname, self.outputname))
 
     def save_files(self, filepath):
+        import matplotlib.pyplot as plt
         os.chdir(filepath)
+        self.render()
+        self.create_heatmap()
+        plt.close()
         self.save_mismatch_info()
         self.save_heatmap()
 
@@ -3,22 +3,27 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import json
+import argparse
+import time
+import multiprocessing as mp
+from functools import partial
 from prince import CA
 from scipy import sparse
-cd4, cd8, mhcI, mhcI_ca, mhcII, mhcII_ca, totals, select = ([] for i in range(8)) #initialisation of the antigen selectors
+import HLA_profiler
+dname = os.path.dirname(os.path.abspath(__file__))
 
 bin = np.array([-1, 0, 0.001, 0.01, 1]) #bins for classifications of response strengths for specific antigens
 labels = ["No response", "Weak", "Moderate", "Strong"] #labels for the binning
 
 try:
-    with open("{}/databases/MHCI_clusters.txt".format(os.path.dirname(__file__))) as json_file:
+    with open("{}/databases/MHCI_clusters.txt".format(dname)) as json_file:
         clusters = json.load(json_file)  # cluster dictionary for MHC I
 except FileNotFoundError:
     print("Please ensure 'MHCI_clusters.txt' is in the databases folder.")
     raise
 
 try:
-    with open("{}/databases/MHCII_clusters.txt".format(os.path.dirname(__file__))) as json_file:
+    with open("{}/databases/MHCII_clusters.txt".format(dname)) as json_file:
         clusters2 = json.load(json_file) #cluster dictionary for MHC II
 except FileNotFoundError:
     print("Please ensure 'MHCII_clusters.txt' is in the databases folder.")
@@ -28,19 +33,22 @@ except FileNotFoundError:
 clusters = {k: v+1 for k, v in clusters.items()}
 clusters2 = {k: v+1 for k, v in clusters2.items()}
 
-def run():
+def prepare(writer=None):
     '''
-    The main body of code that deals with preprocessing data, such as applying cluster memberships, separating vaccinated
-    donors and non-vaccinated donors, calculating total values of antigen responses, and binning antigen responses and total
-    antigen responses into classes of strengths.
-    The code then calls the function "analyse" to produce Correspondence Analysis results.
+    Preprocessing shared by run and batch: applies cluster memberships, separates the clusters of vaccinated donors from
+    those of non-vaccinated donors("V" in front), calculates total values of antigen responses, and bins antigen responses
+    and total antigen responses into classes of strengths. Statistics of the data are written to writer if one is given.
+    Returns the prepared dataframe and a dictionary of column pointers('cd4', 'cd8', 'mhcI_ca', 'mhcII_ca').
     The HLA allele excel spreadsheet needs to be named types.xlsx and the response excel spreadsheet needs to be named response.xlsx.
     Both files need to be placed in the spreadsheets directory.
     '''
-    os.chdir("{}/spreadsheets".format(os.path.dirname(__file__)))
-    main = pd.merge(pd.read_excel("response.xlsx"), pd.read_excel("types.xlsx"), how='inner', on='donor') \
-        .set_index('donor') \
-        .replace([-777, -888, -999], [np.nan, 0, 0])  # loads the HLA types and responses of donors and merges them
+    cd4, cd8, mhcI, mhcI_ca, mhcII, mhcII_ca = ([] for i in range(6)) #antigen selectors, new ones on every call
+    totals = ['cd4_total', 'cd8_total']
+    with HLA_profiler.timer("read spreadsheets"):
+        main = pd.merge(pd.read_excel("{}/spreadsheets/response.xlsx".format(dname)),
+                        pd.read_excel("{}/spreadsheets/types.xlsx".format(dname)), how='inner', on='donor') \
+            .set_index('donor') \
+            .replace([-777, -888, -999], [np.nan, 0, 0])  # loads the HLA types and responses of donors and merges them
 
     # sets column pointers for the dataframe
     for column in list(main):
@@ -56,16 +64,12 @@ def run():
     # calculates summated responses of the CMV antigens, and also saves the column names for reference
     main['cd4_total'] = main[cd4].sum(axis=1)
     main['cd8_total'] = main[cd8].sum(axis=1)
-    totals.extend(['cd4_total', 'cd8_total'])
     cd4.append('cd4_total')
     cd8.append('cd8_total')
 
-    os.chdir("{}/output/CA/stats".format(os.path.dirname(__file__)))
-
-    writer = pd.ExcelWriter('stats.xlsx')
-
     # shows std, mean, variances and interquartile ranges of the responses
-    main[cd4+cd8].describe().transpose().to_excel(writer, 'Variation Statistics')
+    if writer is not None:
+        main[cd4+cd8].describe().transpose().to_excel(writer, sheet_name='Variation Statistics')
 
     # bins the summated responses into 5 groups of equal proportions
     main[totals] = main[totals].apply(
@@ -82,19 +86,22 @@ def run():
 
     # shows the frequency of No response, Weak, Moderate, Strong for CMV antigens
     # total binned responses were not shown since they were binned according to equal sizes
-    main[antigens].apply(pd.value_counts).transpose().to_excel(writer, 'Binned Responses')
-    main[['CMVVASC', 'older']].apply(pd.value_counts).to_excel(writer, 'Vaccinated, Older')
+    if writer is not None:
+        main[antigens].apply(lambda x: x.value_counts()).transpose().to_excel(writer, sheet_name='Binned Responses')
+        main[['CMVVASC', 'older']].apply(lambda x: x.value_counts()).to_excel(writer, sheet_name='Vaccinated, Older')
 
     # splits up the two alleles recorded in each HLA type and then places the alleles into clusters they belong to
     # the cluster dictionaries were made using HLA_clusterer.py
     for t in mhcI + mhcII:
         one = '{}.1'.format(t)
         two = '{}.2'.format(t)
-        main[one], main[two] = main[t].str.split(', ', 1).str
+        alleles = main[t].str.split(', ', n=1)
+        main[one], main[two] = alleles.str[0], alleles.str[1]
         main[[one, two]] = main[[one, two]].apply(
             lambda x: t + x)  # places the name of the HLA type in front of the alleles
 
-        main[[one,two]].astype(str).apply(pd.value_counts).to_excel(writer, '{} counts'.format(t))
+        if writer is not None:
+            main[[one,two]].fillna('nan').astype(str).apply(lambda x: x.value_counts()).to_excel(writer, sheet_name='{} counts'.format(t))
 
         # replaces allele names with cluster membership
         if t in mhcI:
@@ -110,15 +117,77 @@ def run():
         main.loc[main['CMVVASC'] == 'Yes', two] = "V" + main[two]
     # drops the columns with the joined HLA alleles
     main = main.drop(columns=mhcI + mhcII).replace(["0", "V0"],[np.nan, np.nan])
+    return main, {'cd4': cd4, 'cd8': cd8, 'mhcI_ca': mhcI_ca, 'mhcII_ca': mhcII_ca}
 
-    writer.save()
+def run():
+    '''
+    The main body of code, which prepares the data with the function "prepare", saving statistics of it in stats.xlsx,
+    then calls the function "analyse" to produce Correspondence Analysis results for every antigen.
+    '''
+    os.makedirs("{}/output/CA/stats".format(dname), exist_ok=True)
+    os.makedirs("{}/output/CA/results".format(dname), exist_ok=True)
+    with HLA_profiler.timer("prepare and write stats.xlsx"):
+        with pd.ExcelWriter("{}/output/CA/stats/stats.xlsx".format(dname)) as writer:
+            main, columns = prepare(writer)
 
-    os.chdir("{}/output/CA/results".format(os.path.dirname(__file__)))
+    os.chdir("{}/output/CA/results".format(dname))
 
     # starts Correspondence Analysis
-    for col in cd4 + cd8:
-        select = set_select(col, main.copy(), mhcI_ca, mhcII_ca)
-        analyse(select, main.copy())
+    for col in columns['cd4'] + columns['cd8']:
+        select = set_select(col, main.copy(), columns['mhcI_ca'], columns['mhcII_ca'])
+        with HLA_profiler.timer("analyse {}".format(col)):
+            analyse(select, main.copy())
+        HLA_profiler.count("antigens analysed")
+
+def correspondence(select, df):
+    '''
+    Correspondence Analysis of the binned responses to one antigen(the first column in select) against the clustered
+    alleles(the other columns). Returns the contingency table(with totals), the fitted CA, and the Indexed Residuals and
+    z-scores(Standardised Residuals) as dataframes.
+    '''
+    id, select = select[0], select[1:] #antigen name and clustered allele columns
+    test = df[[id] + select] #selects relevant data for current iteration of antigen responses
+
+    #creation of contigency table
+    test = test.melt(id_vars=id, value_vars=select, value_name="type").dropna()
+    table = pd.crosstab(test.type, test[id], margins=True, margins_name="Total")
+
+    #uses CA from prince library to perform correspondence analysis
+    test = table.drop(["Total"]).drop(["Total"], axis=1)
+    with HLA_profiler.timer("CA fit"):
+        ca = CA().fit(test)
+
+    #calculation of Indexed Residuals and z-score(Standardised Residuals)
+    test = test.apply(lambda x: x / np.sum(np.sum(test)))
+    r = ca.row_masses_.values
+    c = ca.col_masses_.values
+    S = sparse.diags(r) @ (test - np.outer(r, c)) @ sparse.diags(c)
+    S2 = sparse.diags(r ** -0.5) @ (test - np.outer(r, c)) @ sparse.diags(c ** -0.5)
+    data = pd.DataFrame(data=S / np.outer(r, c), index=test.index, columns=test.columns)
+    data2 = pd.DataFrame(data=S2, index=test.index, columns=test.columns)
+    return table, ca, data, data2
+
+def plot_coordinates(ca, test):
+    '''
+    Plots the principal coordinates of the clustered alleles(rows) and response classes(columns) on the first two
+    components, like CA.plot_coordinates from prince, which no longer works with pandas 1.0 and later.
+    '''
+    X = test.to_numpy(dtype=float)
+    rows = X / X.sum(axis=1)[:, None] @ np.diag(ca.col_masses_.to_numpy() ** -0.5) @ ca.V_.T
+    columns = X.T / X.T.sum(axis=1)[:, None] @ np.diag(ca.row_masses_.to_numpy() ** -0.5) @ ca.U_
+    fig, ax = plt.subplots(figsize=(12, 12))
+    ax.grid(linestyle='--')
+    ax.axhline(0, color='black', linewidth=0.5)
+    ax.axvline(0, color='black', linewidth=0.5)
+    for coordinates, names, label in ((rows, test.index, test.index.name), (columns, test.columns, test.columns.name)):
+        ax.scatter(coordinates[:, 0], coordinates[:, 1], label=label)
+        for x, y, name in zip(coordinates[:, 0], coordinates[:, 1], names):
+            ax.annotate(name, (x, y))
+    ax.legend()
+    inertia = ca.explained_inertia_
+    ax.set_xlabel('Component 0 ({:.2f}% inertia)'.format(100 * inertia[0]))
+    ax.set_ylabel('Component 1 ({:.2f}% inertia)'.format(100 * inertia[1]))
+    return ax
 
 def analyse(select, df):
     '''
@@ -127,29 +196,16 @@ def analyse(select, df):
     HLA alleles(grouped by similarity) and antigen responses observed by donors
     and how statistically significant the correlations are between them.
     '''
-    select = select #columns selected by set_select function
-    df = df #main dataframe containing all information
-    test = df[select] #selects relevant data for current iteration of antigen responses
-    id = select.pop(0) #antigen name
+    id = select[0] #antigen name
     print("Performing Correspondence Analysis for {}".format(id))
+    table, ca, data, data2 = correspondence(select, df)
 
-    #creation of contigency table
-    test = test.melt(id_vars=id, value_vars=select, value_name="type").dropna()
-    test = pd.crosstab(test.type, test[id], margins=True, margins_name="Total")
-
-    #creation of excel spreadsheet and saved contigency table onto the 1st sheet
-    writer = pd.ExcelWriter('{}.xlsx'.format(id))
-    test.to_excel(writer, 'Contingency Table')
-
-    #uses CA from prince library to perform correspondence analysis and plot graphs
-    ca = CA()
-    test = test.drop(["Total"]).drop(["Total"], axis=1)
-    ca = ca.fit(test)
-    ax = ca.plot_coordinates(test, figsize=(12, 12))
+    #plots the graph of the correspondence analysis
+    ax = plot_coordinates(ca, table.drop(["Total"]).drop(["Total"], axis=1))
     ax.set_title('Clustered alleles vs {} binned responses'.format(id))
 
     #graph plotted is saved in the ~/CA/graphs folder
-    filepath = "{}/output/CA/results/graphs".format(os.path.dirname(__file__))
+    filepath = "{}/output/CA/results/graphs".format(dname)
     if not os.path.exists(filepath):
         os.makedirs(filepath)
     os.chdir(filepath)
@@ -157,22 +213,17 @@ def analyse(select, df):
     plt.savefig('{}.png'.format(id))
     plt.close()
 
-    #calculation of Indexed Residuals and z-score(Standardised Residuals), which are then saved into the spreadsheet as the 2nd and 3rd sheets
-    test = test.apply(lambda x: x / np.sum(np.sum(test)))
-    r = ca.row_masses_.values
-    c = ca.col_masses_.values
-    S = sparse.diags(r) @ (test - np.outer(r, c)) @ sparse.diags(c)
-    S2 = sparse.diags(r ** -0.5) @ (test - np.outer(r, c)) @ sparse.diags(c ** -0.5)
-    data = S / np.outer(r, c)
-    data2 = S2
-    data = pd.DataFrame(data=data, index=test.index, columns=test.columns).to_excel(writer, 'Indexed Residuals')
-    data2 = pd.DataFrame(data=data2, index=test.index, columns=test.columns).to_excel(writer, 'z-scores')
-
-    filepath = "{}/output/CA/results/{}".format(os.path.dirname(__file__), id[4:])
+    #the contigency table, Indexed Residuals and z-scores are saved as the 1st, 2nd and 3rd sheets of a spreadsheet in
+    #the ~/CA/results/<antigen> folder
+    filepath = "{}/output/CA/results/{}".format(dname, id[4:])
     if not os.path.exists(filepath):
         os.makedirs(filepath)
     os.chdir(filepath)
-    writer.save()
+    with HLA_profiler.timer("write CA results"):
+        with pd.ExcelWriter('{}.xlsx'.format(id)) as writer:
+            table.to_excel(writer, sheet_name='Contingency Table')
+            data.to_excel(writer, sheet_name='Indexed Residuals')
+            data2.to_excel(writer, sheet_name='z-scores')
     print("Results saved as {}.xlsx and {}.png".format(id, id))
 
 
@@ -190,8 +241,136 @@ def set_select(col, df, mhcI_ca, mhcII_ca):
             select.extend(mhcI_ca)
         return select
 
+#subgroups analysed by batch when no cohorts are given
+default_cohorts = {
+    'all': {},
+    'vaccinated': {'CMVVASC': 'Yes'},
+    'not vaccinated': {'CMVVASC': 'No'},
+    'older': {'older': 'Yes'},
+    'younger': {'older': 'No'},
+}
+
+def cohort_mask(main, spec):
+    '''
+    Which donors of the prepared dataframe belong to a cohort. A cohort can be given as a dictionary of column: value(or
+    list of values) pairs that donors must all match, as the path of a .xlsx or .csv file with a 'donor' column listing
+    its donors, or as a function taking the dataframe and returning a boolean series. An empty cohort is all donors.
+    Raises ValueError if the columns given cannot be found.
+    '''
+    if callable(spec):
+        return pd.Series(spec(main), index=main.index).astype(bool)
+    if isinstance(spec, str):
+        donors = pd.read_csv(spec) if spec.endswith('.csv') else pd.read_excel(spec)
+        if 'donor' not in donors:
+            raise ValueError("{} has no 'donor' column".format(spec))
+        return pd.Series(main.index.isin(donors['donor']), index=main.index)
+    missing = [column for column in (spec or {}) if column not in main.columns]
+    if missing:
+        raise ValueError("Cohort columns {} cannot be found in the spreadsheets".format(", ".join(map(str, missing))))
+    mask = pd.Series(True, index=main.index)
+    for column, value in (spec or {}).items():
+        mask &= main[column].isin(value if isinstance(value, (list, tuple, set)) else [value])
+    return mask
+
+shared = None #prepared dataframe, column pointers and cohort masks used by the batch worker processes, set by init_batch
+
+def init_batch(data):
+    global shared
+    shared = data
+
+def batch_task(task):
+    '''
+    Correspondence Analysis of one antigen in one cohort, run in a worker process on the shared prepared dataframe.
+    Cohorts too small for an analysis(no donors, or no typed alleles, which leave an empty contingency table, or tables
+    the CA cannot be fitted to) give an error message instead of results.
+    '''
+    cohort, antigen = task
+    main, columns, masks = shared
+    df = main[masks[cohort]]
+    if df.empty:
+        return cohort, antigen, None, "no donors in the cohort"
+    try:
+        table, ca, data, data2 = correspondence(set_select(antigen, df, columns['mhcI_ca'], columns['mhcII_ca']), df)
+    except ValueError as e: #also raised by numpy.linalg.LinAlgError
+        return cohort, antigen, None, "{}: {}".format(type(e).__name__, e)
+    inertia = sum(ca.explained_inertia_[:2])
+    return cohort, antigen, (table, data, data2, int(masks[cohort].sum()), inertia), None
+
+def batch(cohorts=None, antigens=None, workers=None, filename="batch.xlsx"):
+    '''
+    Correspondence Analysis of every antigen(or only the ones given) in every cohort, with the data prepared only once
+    and the (cohort, antigen) analyses spread over a pool of worker processes. Cohorts are a dictionary of name: cohort,
+    where each cohort is given as in cohort_mask, and default_cohorts is used if none are given. No graphs are drawn.
+    All results are saved in a single spreadsheet in ~/output/CA/results, with the cohort and antigen as the first two
+    index levels of every sheet, and a summary sheet of the donors and inertia explained by the first two axes(or the
+    error) of each analysis.
+    The total responses are binned into quintiles of all donors, not of each cohort, so that their classes are the same
+    in every cohort.
+    '''
+    cohorts = cohorts or default_cohorts
+    with HLA_profiler.timer("prepare"):
+        main, columns = prepare()
+    masks = {name: cohort_mask(main, spec) for name, spec in cohorts.items()}
+    antigens = antigens or columns['cd4'] + columns['cd8']
+    unknown = [antigen for antigen in antigens if antigen not in columns['cd4'] + columns['cd8']]
+    if unknown: #checked before starting the pool, as set_select gives None for them
+        raise ValueError("Unknown antigens {}, choose from {}".format(", ".join(unknown),
+                                                                       ", ".join(columns['cd4'] + columns['cd8'])))
+    tasks = [(cohort, antigen) for cohort in cohorts for antigen in antigens]
+
+    sheets = {'Contingency Table': {}, 'Indexed Residuals': {}, 'z-scores': {}}
+    summary = []
+    start = time.perf_counter()
+    with HLA_profiler.sampling("batch"), \
+            mp.Pool(workers or mp.cpu_count(), init_batch, ((main, columns, masks),)) as pool:
+        timed = []
+        for (cohort, antigen, result, error), seconds, pid in pool.imap_unordered(
+                partial(HLA_profiler.timed_call, batch_task), tasks):
+            timed.append((None, seconds, pid))
+            if error:
+                print("Correspondence Analysis failed for {} in {}: {}".format(antigen, cohort, error))
+                summary.append((cohort, antigen, int(masks[cohort].sum()), np.nan, error))
+                continue
+            for sheet, frame in zip(sheets, result[:3]):
+                sheets[sheet][(cohort, antigen)] = frame
+            summary.append((cohort, antigen, result[3], result[4], ""))
+            HLA_profiler.count("antigens analysed")
+    HLA_profiler.record_pool("batch", timed, time.perf_counter() - start, workers or mp.cpu_count())
+
+    filepath = "{}/output/CA/results".format(dname)
+    os.makedirs(filepath, exist_ok=True)
+    order = {task: k for k, task in enumerate(tasks)}
+    with HLA_profiler.timer("write batch results"):
+        summary = pd.DataFrame(sorted(summary, key=lambda x: order[x[:2]]),
+                               columns=['cohort', 'antigen', 'donors', 'inertia (2 axes)', 'error'])
+        with pd.ExcelWriter("{}/{}".format(filepath, filename)) as writer:
+            summary.set_index(['cohort', 'antigen']).to_excel(writer, sheet_name='Summary')
+            for sheet, frames in sheets.items():
+                keys = sorted(frames, key=order.get)
+                if keys:
+                    pd.concat([frames[key] for key in keys], keys=keys,
+                              names=['cohort', 'antigen']).to_excel(writer, sheet_name=sheet)
+    print("Results of {} analyses saved as {}".format(len(tasks), filename))
+    return summary
+
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser(description="Correspondence Analysis of clustered HLA alleles and CMV responses.")
+    parser.add_argument('--batch', nargs='?', const='', metavar='COHORTS',
+                        help="analyse several cohorts at once instead, given as a .json file of name: cohort "
+                             "(default: all, vaccinated, not vaccinated, older and younger donors)")
+    parser.add_argument('--antigens', nargs='*', help="only analyse these antigens in --batch")
+    parser.add_argument('--workers', type=int, help="number of worker processes for --batch")
+    args = parser.parse_args()
+    with HLA_profiler.profile("CA"):
+        if args.batch is not None:
+            cohorts = None
+            if args.batch:
+                with open(args.batch) as json_file:
+                    cohorts = json.load(json_file)
+            batch(cohorts, args.antigens, args.workers)
+        else:
+            run()
+    HLA_profiler.report("CA")
     print("Correspodence Analysis successful. Please check the results in the ~\output\CA directory.")
     print("The stats folder contains a spreadsheet with sheets showing information of the data, "
           "such as frequency of alleles and interquartile ranges of responses. Graphs of all"
@@ -2,11 +2,19 @@ from mpl_toolkits.mplot3d import Axes3D
 from mpl_toolkits import mplot3d
 from sklearn.mixture import GaussianMixture as GMM
 from sklearn import manifold as mn
+from scipy.cluster import hierarchy
+from scipy.sparse.csgraph import laplacian
+from scipy.linalg import eigh
+from sklearn.metrics import silhouette_score
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+import multiprocessing as mp
+import argparse
+import hashlib
 import os
 import json
+import HLA_profiler
 
 #opens up HLA database
 try:
@@ -16,15 +24,180 @@ except FileNotFoundError:
     print("Please ensure 'HLA_alleles.txt' is in the databases folder.")
     raise
 
-os.chdir("{}/databases/sim_matrix".format(os.path.dirname(__file__)))
+def load_matrices():
+    '''
+    Opens up similarity matrices formed from HLA_sim_mat.py.
+    '''
+    os.chdir("{}/databases/sim_matrix".format(os.path.dirname(__file__)))
+    try:
+        with HLA_profiler.timer("read sim_matrix.xlsx"):
+            datamhcI = pd.read_excel("sim_matrix.xlsx", index_col=0)
+            datamhcII = pd.read_excel("sim_matrix.xlsx", 1, index_col=0)
+    except FileNotFoundError:
+        print("Please ensure 'sim_matrix.xlsx' is in the databases folder.")
+        raise
+    return datamhcI, datamhcII
 
-#opens up similarity matrices formed from HLA_sim_mat.py
-try:
-    datamhcI = pd.read_excel("sim_matrix.xlsx", index_col=0)
-    datamhcII = pd.read_excel("sim_matrix.xlsx", 1, index_col=0)
-except FileNotFoundError:
-    print("Please ensure 'sim_matrix.xlsx' is in the databases folder.")
-    raise
+def cluster(data, n_dims, n_components, name=""):
+    '''
+    Laplacian eigenmapping of a similarity matrix into n_dims dimensions, followed by clustering into n_components
+    clusters using Gaussian Mixture Models. Returns the embedding and the cluster labels.
+    '''
+    with HLA_profiler.timer("spectral_embedding {}".format(name).strip()):
+        data = mn.spectral_embedding(data, n_components=n_dims, drop_first=True, random_state=11)
+    with HLA_profiler.timer("GMM {}".format(name).strip()):
+        labels = GMM(n_components, random_state=22).fit(data).predict(data)
+    return data, labels
+
+def eigenbasis(data, max_dims=30):
+    '''
+    Laplacian eigenmap of a similarity matrix with max_dims dimensions, computed the same way as spectral_embedding(with
+    drop_first), so that the embedding for any smaller number of dimensions n is just the first n columns.
+
+    Results are cached in ~/output/cluster_data/eigenbasis, keyed by a hash of the matrix, so the eigen-decomposition is
+    only done once for each matrix, unless more dimensions are asked for than were cached.
+    '''
+    data = np.ascontiguousarray(data, dtype=float)
+    folder = "{}/output/cluster_data/eigenbasis".format(os.path.dirname(os.path.abspath(__file__)))
+    filename = "{}/{}.npy".format(folder, hashlib.sha256(data.tobytes() + str(data.shape).encode()).hexdigest())
+    if os.path.exists(filename):
+        basis = np.load(filename)
+        if basis.shape[1] >= max_dims:
+            return basis[:, :max_dims]
+    with HLA_profiler.timer("eigenbasis"):
+        lap, dd = laplacian(data, normed=True, return_diag=True)
+        np.fill_diagonal(lap, 1)
+        vectors = eigh(lap, subset_by_index=[0, max_dims])[1] / dd[:, None]
+        #same sign convention as spectral_embedding, where the largest absolute value of each eigenvector is positive
+        vectors *= np.sign(vectors[np.argmax(np.abs(vectors), axis=0), range(vectors.shape[1])])
+    basis = vectors[:, 1:]
+    os.makedirs(folder, exist_ok=True)
+    np.save(filename, basis)
+    return basis
+
+def purity(labels, names):
+    '''
+    How well clusters separate HLA-types by locus. Overall purity is the fraction of alleles belonging to the most common
+    locus of their cluster. The purity of a locus is the mean fraction of cluster members sharing that locus, over its
+    alleles.
+    '''
+    loci = pd.Series([name.split('*')[0] for name in names])
+    table = pd.crosstab(pd.Series(labels, name='cluster'), loci.rename('locus'))
+    shares = table.div(table.sum(axis=1), axis=0)
+    result = {'purity': table.max(axis=1).sum() / len(names)}
+    for locus in table.columns:
+        result['purity {}'.format(locus)] = (table[locus] * shares[locus]).sum() / table[locus].sum()
+    return result
+
+def sweep(df, dims=range(2, 21), components=range(2, 25)):
+    '''
+    Evaluates every combination of embedding dimensions and number of GMM clusters on a similarity matrix(dataframe
+    with allele names as index), using one cached eigenbasis sliced to each number of dimensions instead of
+    recomputing the embedding. Returns a table with the BIC, AIC, silhouette score and locus purity of each fit.
+    '''
+    basis = eigenbasis(df.values, max(dims))
+    rows = []
+    with HLA_profiler.timer("sweep"):
+        for n_dims in dims:
+            data = basis[:, :n_dims]
+            for n_components in components:
+                model = GMM(n_components, random_state=22).fit(data)
+                labels = model.predict(data)
+                n_labels = len(set(labels))
+                row = {'n_dims': n_dims, 'n_components': n_components, 'bic': model.bic(data), 'aic': model.aic(data),
+                       'silhouette': silhouette_score(data, labels) if 1 < n_labels < len(data) else np.nan}
+                row.update(purity(labels, df.index))
+                rows.append(row)
+    HLA_profiler.count("sweep fits", len(rows))
+    return pd.DataFrame(rows)
+
+def run_sweep(dims=range(2, 21), components=range(2, 25)):
+    '''
+    Runs sweep on both similarity matrices and saves the tables as MHCI_sweep.xlsx and MHCII_sweep.xlsx in
+    ~/output/cluster_data, printing the settings with the lowest BIC.
+    '''
+    datamhcI, datamhcII = load_matrices()
+    os.chdir("{}/output/cluster_data".format(os.path.dirname(__file__)))
+    for name, df in (("MHCI", datamhcI), ("MHCII", datamhcII)):
+        table = sweep(df, dims, components)
+        table.to_excel('{}_sweep.xlsx'.format(name), sheet_name='Sweep', index=False)
+        print("{} settings with the lowest BIC:".format(name))
+        print(table.sort_values('bic').head().to_string(index=False))
+
+shared = None #similarity matrix used by the consensus worker processes, set once per process by init_replicate
+
+def init_replicate(data):
+    global shared
+    shared = data
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1) #one thread per process, as the processes already use all CPU cores
+    except ImportError:
+        pass
+
+def replicate(args):
+    '''
+    One consensus replicate: the embedding and GMM are reseeded, and if fraction is below 1, only a random subset of
+    the alleles is clustered. Returns the indexes of the alleles used and their cluster labels.
+    '''
+    seed, n_dims, n_components, fraction = args
+    rng = np.random.RandomState(seed)
+    index = np.arange(len(shared))
+    if fraction < 1:
+        index = np.sort(rng.choice(index, int(round(fraction * len(index))), replace=False))
+    data = mn.spectral_embedding(shared[np.ix_(index, index)], n_components=n_dims, drop_first=True, random_state=seed)
+    labels = GMM(n_components, random_state=seed).fit(data).predict(data)
+    return index, labels
+
+def consensus(data, n_dims, n_components, replicates=200, fraction=1.0, workers=None, name=""):
+    '''
+    Consensus clustering to see how stable the cluster assignments are. Replicates are run in a pool of worker processes,
+    and as each one finishes the number of times every pair of alleles was put in the same cluster(and was clustered
+    together at all) is added up, so that label vectors do not need to be kept.
+
+    Returns the consensus matrix(fraction of replicates in which each pair shared a cluster), a consensus partition found
+    by average linkage clustering of the consensus matrix into n_components clusters, and the stability of each allele,
+    which is the mean consensus between it and the other members of its consensus cluster.
+    '''
+    n = len(data)
+    together = np.zeros((n, n))
+    sampled = np.zeros((n, n))
+    tasks = [(seed, n_dims, n_components, fraction) for seed in range(replicates)]
+    with HLA_profiler.timer("consensus {}".format(name).strip()):
+        with mp.Pool(workers or mp.cpu_count(), init_replicate, (data,)) as pool:
+            for index, labels in pool.imap_unordered(replicate, tasks, chunksize=max(1, replicates // 64)):
+                pair = np.ix_(index, index)
+                together[pair] += labels[:, None] == labels[None, :]
+                sampled[pair] += 1
+    HLA_profiler.count("consensus replicates", replicates)
+    matrix = np.divide(together, sampled, out=np.zeros((n, n)), where=sampled > 0)
+    distance = 1 - matrix[np.triu_indices(n, 1)]
+    partition = hierarchy.fcluster(hierarchy.linkage(distance, 'average'), n_components, 'maxclust') - 1
+    stability = np.ones(n)
+    for i in range(n):
+        members = np.flatnonzero((partition == partition[i]) & (np.arange(n) != i))
+        if len(members):
+            stability[i] = matrix[i, members].mean()
+    return matrix, partition, stability
+
+def run_consensus(replicates=200, fraction=1.0, workers=None):
+    '''
+    Runs consensus clustering on both similarity matrices with the same settings as run(). Per-allele stability scores,
+    the consensus partition and the cluster given by a single run are saved as MHCI_stability.xlsx and
+    MHCII_stability.xlsx in ~/output/cluster_data.
+    '''
+    datamhcI, datamhcII = load_matrices()
+    os.chdir("{}/output/cluster_data".format(os.path.dirname(__file__)))
+    for name, df, n_components in (("MHCI", datamhcI, 8), ("MHCII", datamhcII, 7)):
+        labels = cluster(df.values, 5, n_components)[1]
+        matrix, partition, stability = consensus(df.values, 5, n_components, replicates, fraction, workers, name)
+        result = pd.DataFrame({'cluster': labels, 'consensus_cluster': partition, 'stability': stability},
+                              index=df.index).sort_values('stability')
+        with pd.ExcelWriter('{}_stability.xlsx'.format(name)) as writer:
+            result.to_excel(writer, sheet_name='Stability')
+            pd.DataFrame(matrix, index=df.index, columns=df.index).to_excel(writer, sheet_name='Consensus matrix')
+        print("{}: mean stability {:.3f}, {} of {} alleles below 0.8".format(name, stability.mean(),
+                                                                            int((stability < 0.8).sum()), len(stability)))
 
 def run():
     '''
@@ -35,31 +208,33 @@ def run():
 
     The commented out code was used to create plots of the first 2 or 3 eigenvectors with the largest eigenvalues.
     '''
+    datamhcI, datamhcII = load_matrices()
+
     #removes the labels/names of alleles from the similarity matrices for spectral embedding/laplacian eigenmaps
     data = datamhcI.values
     data2 = datamhcII.values
     
 
     #laplacian eigenmapping of MHC I similarity matrix, followed by clustering using Gaussian Mixture Models.
-    data = mn.spectral_embedding(data, 5, drop_first=True, random_state=11)
-    labels = GMM(8, random_state=22).fit(data).predict(data)
+    data, labels = cluster(data, 5, 8, "MHC I")
 
     #produces linegraphs showing change in BIC, which suggests the number of clusters for a better model
     #saved in output/cluster_data
     os.chdir("{}/output/cluster_data".format(os.path.dirname(__file__)))
 
     n_components = np.arange(1, 25)
-    models = [GMM(n, covariance_type= 'full', random_state=22).fit(data) for n in n_components]
+    with HLA_profiler.timer("GMM BIC sweep MHC I"):
+        models = [GMM(n, covariance_type= 'full', random_state=22).fit(data) for n in n_components]
     plt.plot(n_components, [m.bic(data) for m in models], label='BIC')
     plt.plot(n_components, [m.aic(data) for m in models], label='AIC')
     plt.savefig("BIC_graph_MHC1.png")
     plt.close()
 
     #earlier steps repeated for MHC II similarity matrix
-    data2 = mn.spectral_embedding(data2, 5, drop_first=True, random_state=11)
-    labels2 = GMM(7, random_state=22).fit(data2).predict(data2)
+    data2, labels2 = cluster(data2, 5, 7, "MHC II")
 
-    models = [GMM(n, covariance_type= 'full', random_state=22).fit(data2) for n in n_components]
+    with HLA_profiler.timer("GMM BIC sweep MHC II"):
+        models = [GMM(n, covariance_type= 'full', random_state=22).fit(data2) for n in n_components]
     plt.plot(n_components, [m.bic(data2) for m in models], label='BIC')
     plt.plot(n_components, [m.aic(data2) for m in models], label='AIC')
     plt.savefig("BIC_graph_MHC2.png")
@@ -130,7 +305,27 @@ def run():
     file.close()
 
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser(description="Clusters HLA alleles using their similarity matrices.")
+    parser.add_argument('--consensus', type=int, metavar='REPLICATES',
+                        help="check the stability of the clusters with this many consensus replicates instead")
+    parser.add_argument('--fraction', type=float, default=1.0,
+                        help="fraction of alleles resampled in each consensus replicate(default: all, only reseeded)")
+    parser.add_argument('--workers', type=int, help="number of worker processes for consensus replicates")
+    parser.add_argument('--sweep', action='store_true',
+                        help="compare numbers of embedding dimensions and clusters instead")
+    parser.add_argument('--dims', type=int, nargs=2, default=[2, 20], metavar=('MIN', 'MAX'),
+                        help="range of embedding dimensions for --sweep")
+    parser.add_argument('--components', type=int, nargs=2, default=[2, 24], metavar=('MIN', 'MAX'),
+                        help="range of numbers of clusters for --sweep")
+    args = parser.parse_args()
+    with HLA_profiler.profile("HLA_clusterer"):
+        if args.consensus:
+            run_consensus(args.consensus, args.fraction, args.workers)
+        elif args.sweep:
+            run_sweep(range(args.dims[0], args.dims[1] + 1), range(args.components[0], args.components[1] + 1))
+        else:
+            run()
+    HLA_profiler.report("HLA_clusterer")
     print("Clustering done. Please proceed to CA.py to see how the clustered alleles correlate with response "
           "patterns of specific CMV antigens.")
     print("Keeping this window open will help in reading the correspondence analysis charts later, "
@@ -0,0 +1,173 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import HLA_profiler
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+dname = os.path.dirname(os.path.abspath(__file__))
+state_file = "{}/output/pipeline_state.json".format(dname)
+
+#folders the scripts change directory into, which need to exist before they are run
+folders = ["output/cluster_data", "output/CA/stats", "output/CA/results", "databases/sim_matrix"]
+
+
+class Stage:
+    '''
+    One script of the workflow. Inputs and outputs are paths relative to the project folder. The script itself, and the
+    local modules it uses to compute its results(modules), are always counted as inputs, so changing their code also
+    causes the stage to be run again. HLA_profiler only records timings, so it is left out. Parameters are passed on to
+    the script's run function and are part of the fingerprint as well.
+    '''
+    def __init__(self, name, module, inputs, outputs, requires=(), params=None, modules=()):
+        self.name = name
+        self.module = module
+        self.inputs = ["{}.py".format(m) for m in [module] + list(modules)] + inputs
+        self.outputs = outputs
+        self.requires = list(requires)
+        self.params = params or {}
+
+    def fingerprint(self):
+        sha = hashlib.sha256()
+        for path in self.inputs:
+            sha.update(path.encode())
+            if not os.path.exists("{}/{}".format(dname, path)):
+                continue #missing inputs give a different fingerprint, so the stage is never up to date
+            with open("{}/{}".format(dname, path), 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    sha.update(block)
+        sha.update(json.dumps(self.params, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def up_to_date(self, state):
+        return state.get(self.name) == self.fingerprint() and \
+               all(os.path.exists("{}/{}".format(dname, path)) for path in self.outputs)
+
+    def execute(self):
+        '''
+        Runs the stage in its own python process, since the scripts change the working directory and keep results in
+        module level lists, and so that independent stages can run at the same time.
+        '''
+        code = "import HLA_profiler, {0}\nwith HLA_profiler.profile({0!r}):\n    {0}.run(**{1!r})\n" \
+               "HLA_profiler.report({0!r})".format(self.module, self.params)
+        return subprocess.run([sys.executable, "-c", code], cwd=dname).returncode
+
+
+stages = [
+    Stage("retriever", "HLA_retriever",
+          ["databases/hla_nom_g.txt", "databases/hla_nom_p.txt", "databases/HLA-A.txt", "databases/HLA-B.txt",
+           "databases/HLA-C.txt", "databases/HLA-DRB1.txt", "databases/HLA-DQB1.txt"],
+          ["databases/HLA_alleles.txt", "databases/HLA_groups.txt", "databases/HLA_alleles_index.txt",
+           "databases/HLA_frames.npz"]),
+    Stage("typecheck", "HLA_typecheck",
+          ["spreadsheets/types.xlsx", "databases/HLA_groups.txt", "databases/HLA_alleles.txt"],
+          [], requires=["retriever"]),
+    Stage("sim_mat", "HLA_sim_mat",
+          ["spreadsheets/types.xlsx", "databases/HLA_alleles.txt", "databases/HLA_alleles_index.txt",
+           "databases/HLA_frames.npz"],
+          ["databases/sim_matrix/sim_matrix.xlsx", "databases/sim_matrix/MHCI_matrix.npy",
+           "databases/sim_matrix/MHCI_names.txt", "databases/sim_matrix/MHCII_matrix.npy",
+           "databases/sim_matrix/MHCII_names.txt", "output/cluster_data/mhcI_heatmap.png",
+           "output/cluster_data/mhcII_heatmap.png"],
+          requires=["retriever"], modules=["HLA_retriever", "HLA_visualiser"]),
+    Stage("clusterer", "HLA_clusterer",
+          ["databases/sim_matrix/sim_matrix.xlsx", "databases/HLA_alleles.txt"],
+          ["databases/MHCI_clusters.txt", "databases/MHCII_clusters.txt"], requires=["sim_mat"]),
+    Stage("visualise", "HLA_visualiser",
+          ["databases/sim_matrix/sim_matrix.xlsx", "databases/sim_matrix/MHCI_matrix.npy",
+           "databases/sim_matrix/MHCI_names.txt", "databases/sim_matrix/MHCII_matrix.npy",
+           "databases/sim_matrix/MHCII_names.txt", "databases/MHCI_clusters.txt", "databases/MHCII_clusters.txt"],
+          ["output/cluster_data/mhcI_heatmap.png", "output/cluster_data/mhcII_heatmap.png"], requires=["clusterer"]),
+    Stage("CA", "CA",
+          ["spreadsheets/response.xlsx", "spreadsheets/types.xlsx", "databases/MHCI_clusters.txt",
+           "databases/MHCII_clusters.txt"],
+          ["output/CA/stats/stats.xlsx"], requires=["clusterer"]),
+]
+
+
+def load_state():
+    try:
+        with open(state_file) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state):
+    with open(state_file, 'w') as outfile:
+        json.dump(state, outfile, indent=1)
+
+
+def run(stages=stages, force=(), touch=False, jobs=2):
+    '''
+    Runs the stages in dependency order, skipping the ones whose inputs have not changed since they last succeeded.
+    Since inputs are fingerprinted by content, a stage that reran but produced identical outputs does not cause the stages
+    after it to run again. Stages that do not depend on each other are run at the same time, up to jobs at once.
+    With touch, the current fingerprints are recorded without running anything, to adopt results that already exist.
+    '''
+    for folder in folders:
+        os.makedirs("{}/{}".format(dname, folder), exist_ok=True)
+    state = load_state()
+    if touch:
+        state.update({stage.name: stage.fingerprint() for stage in stages})
+        save_state(state)
+        print("Recorded fingerprints of {} stages.".format(len(stages)))
+        return state
+
+    names = [stage.name for stage in stages]
+    waiting = list(stages)
+    done, failed, running = set(), set(), {}
+    with ThreadPoolExecutor(jobs) as executor:
+        while waiting or running:
+            for stage in list(waiting):
+                required = [r for r in stage.requires if r in names]
+                if any(r in failed for r in required):
+                    print("Skipping {}, as a stage it requires has failed.".format(stage.name))
+                    failed.add(stage.name)
+                    waiting.remove(stage)
+                elif all(r in done for r in required):
+                    waiting.remove(stage)
+                    if stage.name not in force and stage.up_to_date(state):
+                        print("{} is up to date.".format(stage.name))
+                        done.add(stage.name)
+                    else:
+                        print("Running {}...".format(stage.name))
+                        running[executor.submit(timed, stage)] = stage
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                returncode, seconds = future.result()
+                HLA_profiler.add_time("stage {}".format(stage.name), seconds)
+                if returncode == 0:
+                    print("{} finished in {:.1f} s.".format(stage.name, seconds))
+                    state[stage.name] = stage.fingerprint()
+                    save_state(state)
+                    done.add(stage.name)
+                else:
+                    print("{} failed with exit code {}.".format(stage.name, returncode))
+                    failed.add(stage.name)
+    return state
+
+
+def timed(stage):
+    start = time.perf_counter()
+    returncode = stage.execute()
+    return returncode, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the HLA workflow, skipping stages that are up to date.")
+    parser.add_argument('stages', nargs='*', help="only run these stages (default: all)")
+    parser.add_argument('--force', nargs='*', default=[], help="run these stages even if they are up to date")
+    parser.add_argument('--touch', action='store_true',
+                        help="record existing results as up to date without running anything")
+    parser.add_argument('--jobs', type=int, default=2, help="number of stages run at the same time")
+    args = parser.parse_args()
+    selected = [stage for stage in stages if not args.stages or stage.name in args.stages]
+    run(selected, args.force, args.touch, args.jobs)
+    HLA_profiler.report("HLA_pipeline")
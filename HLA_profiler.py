@@ -0,0 +1,235 @@
+'''
+Lightweight instrumentation used by the other scripts. Timers and counters are kept in memory and written out as a JSON
+run report (with a summary table printed) by calling report() at the end of a script. While a timer runs, a background
+thread samples the memory resident in the process and its child processes, and the highest value is kept as the peak
+of that timer. The peak memory use of the whole run is reported as well.
+
+Setting the environment variable HLA_PROFILE to 'cprofile' or 'pyinstrument' also profiles the code run under profile(),
+saving the results next to the report.
+'''
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: #not available on Windows, where psutil is used instead if it is installed
+    resource = None
+
+dname = os.path.dirname(os.path.abspath(__file__))
+report_folder = "{}/output/reports".format(dname)
+
+timers = {}
+counters = {}
+memory = {}
+sample_interval = 0.05 #seconds between samples of memory use while a timer runs
+started = time.time()
+
+
+def peak_rss():
+    '''
+    Peak resident memory in MB of this process and of its finished child processes(e.g. the multiprocessing pool), or
+    None if it cannot be found.
+    '''
+    if resource is not None:
+        scale = 1 if sys.platform == 'darwin' else 1024 #ru_maxrss is in bytes on macOS, in KB on Linux
+        usage = [resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        return [u * scale / 2 ** 20 for u in usage]
+    try:
+        import psutil
+        return [psutil.Process().memory_info().peak_wset / 2 ** 20, None]
+    except (ImportError, AttributeError):
+        return None
+
+
+def current_rss():
+    '''
+    Memory in MB resident right now in this process and its child processes(e.g. the multiprocessing pool), read from
+    /proc on Linux or with psutil if it is installed, or None if it cannot be found.
+    '''
+    if os.path.exists('/proc/self/statm'):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open('/proc/{}/stat'.format(entry)) as file:
+                        parent = int(file.read().rsplit(')', 1)[1].split()[1]) #the name in brackets may hold spaces
+                except (OSError, IndexError, ValueError): #the process ended while being read
+                    continue
+                children.setdefault(parent, []).append(int(entry))
+        pids = [os.getpid()]
+        for pid in pids:
+            pids.extend(children.get(pid, []))
+        pages = 0
+        for pid in pids:
+            try:
+                with open('/proc/{}/statm'.format(pid)) as file:
+                    pages += int(file.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        process = psutil.Process()
+        return sum(p.memory_info().rss for p in [process] + process.children(recursive=True)) / 2 ** 20
+    except psutil.Error:
+        return None
+
+
+class Sampler(threading.Thread):
+    '''
+    Samples current_rss every interval seconds in the background until stopped, keeping the highest value as peak(None
+    if memory use cannot be found).
+    '''
+    def __init__(self, interval=sample_interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak = current_rss()
+
+    def update(self):
+        rss = current_rss()
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.update()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.update()
+        return self.peak
+
+
+@contextmanager
+def sampling(name):
+    '''
+    Records the highest memory use of the process and its child processes while the code inside runs as the peak of name.
+    '''
+    sampler = Sampler()
+    if sampler.peak is None:
+        yield
+        return
+    sampler.start()
+    try:
+        yield
+    finally:
+        memory[name] = max(memory.get(name, 0), sampler.stop())
+
+
+def add_time(name, seconds, calls=1, longest=None):
+    '''
+    Adds seconds spent in calls calls to the timer name. The longest call is taken to be the mean one, unless given.
+    '''
+    timer = timers.setdefault(name, {'calls': 0, 'total': 0.0, 'max': 0.0})
+    timer['calls'] += calls
+    timer['total'] += seconds
+    timer['max'] = max(timer['max'], longest if longest is not None else seconds / calls)
+
+
+def count(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    with sampling(name):
+        try:
+            yield
+        finally:
+            add_time(name, time.perf_counter() - start)
+
+
+def timed_call(function, *args):
+    '''
+    Calls function in a worker process and returns its result together with the time taken and the worker's process id,
+    since timers in worker processes are not seen by the main process.
+    '''
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start, os.getpid()
+
+
+def record_pool(name, tasks, wall, workers):
+    '''
+    Records the results of timed_call for a pool of worker processes: the time spent per task, how many workers were
+    used, and utilisation(time spent computing over time available to the pool). The pool's memory use is recorded by
+    running it under sampling(name).
+    '''
+    if tasks:
+        add_time('{} task'.format(name), sum(t[1] for t in tasks), len(tasks), max(t[1] for t in tasks))
+    add_time(name, wall)
+    count('{} tasks'.format(name), len(tasks))
+    counters['{} workers used'.format(name)] = len(set(t[2] for t in tasks))
+    if wall > 0 and workers > 0:
+        counters['{} utilisation'.format(name)] = round(sum(t[1] for t in tasks) / (wall * workers), 3)
+
+
+@contextmanager
+def profile(name):
+    '''
+    Profiles the code inside, if HLA_PROFILE is set to 'cprofile' or 'pyinstrument'. cProfile results are saved as
+    name.prof(open with pstats or snakeviz), pyinstrument results as name.html.
+    '''
+    mode = os.environ.get('HLA_PROFILE', '').lower()
+    if mode not in ('cprofile', 'pyinstrument'):
+        yield
+        return
+    os.makedirs(report_folder, exist_ok=True)
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats("{}/{}.prof".format(report_folder, name))
+    else:
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open("{}/{}.html".format(report_folder, name), 'w') as outfile:
+                outfile.write(profiler.output_html())
+
+
+def summary():
+    lines = ["{:<40}{:>8}{:>12}{:>12}{:>12}".format("timer", "calls", "total (s)", "mean (s)", "peak MB")]
+    for name, t in timers.items():
+        lines.append("{:<40}{:>8}{:>12.3f}{:>12.4f}{:>12}".format(name[:39], t['calls'], t['total'],
+                                                                   t['total'] / t['calls'],
+                                                                   "{:.0f}".format(memory[name]) if name in memory else "-"))
+    for name, value in counters.items():
+        lines.append("{:<40}{:>8}".format(name[:39], value))
+    rss = peak_rss()
+    if rss is not None:
+        lines.append("peak memory: {:.0f} MB{}".format(rss[0], "" if not rss[1] else
+                                                       ", {:.0f} MB in child processes".format(rss[1])))
+    return "\n".join(lines)
+
+
+def report(name):
+    '''
+    Saves the timers, counters and peak memory of the run so far as name.json in ~/output/reports and prints a summary table.
+    '''
+    os.makedirs(report_folder, exist_ok=True)
+    data = {'name': name, 'started': started, 'wall': time.time() - started, 'peak_rss_mb': peak_rss(),
+            'timers': timers, 'counters': counters, 'memory_mb': memory}
+    with open("{}/{}.json".format(report_folder, name), 'w') as outfile:
+        json.dump(data, outfile, indent=1)
+    print(summary())
+    return data
@@ -1,7 +1,11 @@
 import re
 import json
 import os
+import hashlib
+from collections import Counter
 HLA, HLA_g = ({} for i in range(2))
+residues = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ-' #codes used for residues in the reference-coordinate index
+ON_FRAME, DELETION, OFF_FRAME = 0, 1, 2 #markers of the reference-coordinate index
 
 def extract_GP(**string):
     '''
@@ -56,12 +60,246 @@ def hla_extract(dict, **string):
             json.dump(dict, outfile)
 
 
-if __name__ == '__main__':
+def index_filename(filename):
+    return '{}_index.txt'.format(os.path.splitext(filename)[0])
+
+
+def file_hash(filename):
+    '''
+    Hash of a file's contents, stored in the files built from the HLA dictionary to tell whether they are out of date.
+    '''
+    with open(filename, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def build_index(filename):
+    '''
+    Writes an index next to the HLA dictionary saved by hla_extract, holding the position and length of every allele's
+    sequence within the .json file. The hash of the dictionary file is also stored so that a stale index (from an older
+    HLA_alleles.txt, even one of the same size) can be detected and ignored by AlleleStore.
+    '''
+    with open(filename) as file:
+        text = file.read()
+    index = {}
+    for match in re.finditer(r'"([^"]+)": "([^"]*)"', text):
+        index[match.group(1)] = [match.start(2), len(match.group(2))]
+    with open(index_filename(filename), 'w') as outfile:
+        json.dump({'hash': file_hash(filename), 'alleles': index}, outfile)
+
+
+def build_frames(dict, filename, source):
+    '''
+    Builds a reference-coordinate index of the HLA dictionary. The sequences in the HLA '.txt' files of each locus are
+    already written on a common frame of columns, so for each locus, each allele is stored as an array of residue codes
+    on that frame(the most common sequence length of the locus). Each allele also gets a marker: DELETION if it has
+    deletions('-') on the frame, OFF_FRAME if its length differs from the frame(truncated, or with insertions), so that
+    its position in the frame is unknown.
+
+    Pairs of ON_FRAME alleles can then be compared position by position, without alignment. The hash of the dictionary
+    file the alleles come from(source) is stored as well, so that FrameIndex can tell when the index is out of date.
+    '''
+    import numpy as np
+    loci = {}
+    for name in dict:
+        loci.setdefault(name.split('*')[0], []).append(name)
+    arrays = {}
+    for locus, names in loci.items():
+        width = Counter(len(dict[name]) for name in names).most_common(1)[0][0]
+        codes = np.full((len(names), width), residues.index('-'), dtype=np.uint8)
+        markers = np.full(len(names), ON_FRAME, dtype=np.uint8)
+        for i, name in enumerate(names):
+            sequence = dict[name]
+            if len(sequence) != width or not set(sequence) <= set(residues):
+                markers[i] = OFF_FRAME
+            else:
+                codes[i] = [residues.index(residue) for residue in sequence]
+                if '-' in sequence:
+                    markers[i] = DELETION
+        arrays['{}_names'.format(locus)] = np.array(names)
+        arrays['{}_codes'.format(locus)] = codes
+        arrays['{}_markers'.format(locus)] = markers
+    arrays['source'] = np.array(file_hash(source))
+    np.savez_compressed(filename, **arrays)
+
+
+def score_table(matrix):
+    '''
+    Turns a substitution matrix(dictionary of residue pairs, as from Bio.SubsMat) into an array indexed by residue codes,
+    with nan for pairs missing from the matrix.
+    '''
+    import numpy as np
+    table = np.full((len(residues), len(residues)), np.nan)
+    for (a, b), value in matrix.items():
+        if a in residues and b in residues:
+            table[residues.index(a), residues.index(b)] = table[residues.index(b), residues.index(a)] = value
+    return table
+
+
+def gapped_scores(codes1, codes2, table, gap_open, gap_extend):
+    '''
+    Best score of any global alignment with at least one gap, for each pair of rows of codes1 and codes2(sequences of
+    the same length as residue codes), computed for all pairs at once with an affine gap dynamic programming, one row of
+    the alignment matrix at a time. Gaps in one sequence may directly follow gaps in the other, which only makes the
+    scores higher than, or equal to, those pairwise2 can find.
+    '''
+    import numpy as np
+    pairs, length = codes1.shape
+    columns = np.arange(length + 1)
+    diagonal = np.concatenate([np.zeros((pairs, 1)), np.cumsum(table[codes1, codes2], axis=1)], axis=1)
+    #row 0: only gaps in the first sequence
+    gapped = np.full((pairs, length + 1), -np.inf)
+    gapped[:, 1:] = gap_open + (columns[1:] - 1) * gap_extend
+    vertical = np.full((pairs, length + 1), -np.inf)
+    best = gapped.copy()
+    best[:, 0] = 0
+    for i in range(1, length + 1):
+        aligned = np.full((pairs, length + 1), -np.inf)
+        aligned[:, 1:] = gapped[:, :-1] + table[codes1[:, i - 1][:, None], codes2]
+        vertical = np.maximum(best + gap_open, vertical + gap_extend)
+        other = np.maximum(aligned, vertical)
+        other[:, i] = np.maximum(other[:, i], diagonal[:, i]) #the gapless path, which has no gap yet
+        #horizontal gaps, from the best of the other states anywhere to the left in this row
+        start = np.maximum.accumulate(other - columns * gap_extend, axis=1)
+        horizontal = np.full((pairs, length + 1), -np.inf)
+        horizontal[:, 1:] = start[:, :-1] + gap_open + (columns[1:] - 1) * gap_extend
+        gapped = np.maximum(np.maximum(aligned, vertical), horizontal)
+        best = np.maximum(other, horizontal)
+    return gapped[:, length]
+
+
+def gapless_scores(codes1, codes2, table, gap_open, gap_extend):
+    '''
+    Scores of the gapless alignments of each pair of rows of codes1 and codes2, and whether each is certain to be the
+    best global alignment, i.e. scores higher than any alignment with gaps. Only then pairwise2 finds the same alignment.
+    '''
+    import numpy as np
+    scores = table[codes1, codes2].sum(axis=1)
+    with np.errstate(invalid='ignore'):
+        certain = scores > gapped_scores(codes1, codes2, table, gap_open, gap_extend)
+    return scores, certain
+
+
+def gapless_score(seq1, seq2, matrix, gap_open, gap_extend):
+    '''
+    Score of the gapless alignment of two sequences of the same length, if it is certain to be their best global
+    alignment, otherwise None.
+    '''
+    if len(seq1) != len(seq2) or not set(seq1 + seq2) <= set(residues):
+        return None
+    import numpy as np
+    if id(matrix) not in tables:
+        tables[id(matrix)] = score_table(matrix)
+    codes1 = np.array([[residues.index(residue) for residue in seq1]])
+    codes2 = np.array([[residues.index(residue) for residue in seq2]])
+    scores, certain = gapless_scores(codes1, codes2, tables[id(matrix)], gap_open, gap_extend)
+    return float(scores[0]) if certain[0] else None
+
+tables = {} #score tables of the substitution matrices used by gapless_score
+
+
+class FrameIndex:
+    '''
+    Read-only view of the reference-coordinate index made by build_frames, loaded when first used. An index that was
+    not built from the current HLA dictionary file(source) is treated as missing: load raises FileNotFoundError, so that
+    every pair of alleles is aligned instead.
+    '''
+    def __init__(self, filename, source):
+        self.filename = filename
+        self.source = source
+        self.loci = None
+
+    def load(self):
+        if self.loci is None:
+            import numpy as np
+            loci = {}
+            with np.load(self.filename) as arrays:
+                if 'source' not in arrays.files or str(arrays['source']) != file_hash(self.source):
+                    raise FileNotFoundError("{} is out of date, please run HLA_retriever.py again".format(self.filename))
+                for key in arrays.files:
+                    if key.endswith('_names'):
+                        locus = key[:-len('_names')]
+                        names = arrays[key].tolist()
+                        loci[locus] = ({name: i for i, name in enumerate(names)},
+                                       arrays['{}_codes'.format(locus)], arrays['{}_markers'.format(locus)])
+            self.loci = loci
+        return self.loci
+
+    def locate(self, name):
+        '''
+        Returns the locus, codes and marker of an allele, or None if it is not in the index.
+        '''
+        locus = name.split('*')[0]
+        if locus not in self.load() or name not in self.loci[locus][0]:
+            return None
+        rows, codes, markers = self.loci[locus]
+        return locus, codes[rows[name]], markers[rows[name]]
+
+
+class AlleleStore:
+    '''
+    Read-only, dictionary-like view of the HLA dictionary made by hla_extract. Nothing is read until an allele is first
+    looked up. If an up-to-date index made by build_index exists, only the allele names are loaded and each sequence is
+    read straight from the file when asked for, otherwise the whole dictionary is loaded as before.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = None
+        self.sequences = None
+
+    def load(self):
+        if self.index is not None or self.sequences is not None:
+            return
+        try:
+            with open(index_filename(self.filename)) as json_file:
+                index = json.load(json_file)
+            if index['hash'] == file_hash(self.filename):
+                self.index = index['alleles']
+                self.sequences = {}
+                return
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        with open(self.filename) as json_file:
+            self.sequences = json.load(json_file)
+
+    def __contains__(self, name):
+        self.load()
+        if self.index is not None:
+            return name in self.index
+        return name in self.sequences
+
+    def __getitem__(self, name):
+        self.load()
+        if self.index is not None and name not in self.sequences:
+            offset, length = self.index[name]
+            with open(self.filename, 'rb') as file:
+                file.seek(offset)
+                self.sequences[name] = file.read(length).decode()
+        return self.sequences[name]
+
+    def __iter__(self):
+        self.load()
+        return iter(self.index if self.index is not None else self.sequences)
+
+    def __len__(self):
+        self.load()
+        return len(self.index if self.index is not None else self.sequences)
+
+
+def run():
+    '''
+    Builds the G/P group dictionary, the HLA dictionary and its index in the databases folder.
+    '''
     abspath = os.path.abspath(__file__)
     dname = os.path.dirname(abspath)
     os.chdir('{}/databases'.format(dname))
     extract_GP(G = 'hla_nom_g.txt', P = 'hla_nom_p.txt')
     hla_extract(HLA, A = 'HLA-A.txt', B = 'HLA-B.txt', C = 'HLA-C.txt', DRB1 = 'HLA-DRB1.txt',DQB1 = 'HLA-DQB1.txt')
+    build_index('HLA_alleles.txt')
+    build_frames(HLA, 'HLA_frames.npz', 'HLA_alleles.txt')
+
+
+if __name__ == '__main__':
+    run()
     print("HLA database prepared. Please proceed to HLA_typecheck to check if your types spreadsheet have alleles were not converted to G/P grouped names, if any.")
     print("You can also proceed to Alignment.py if looking to just compare two different alleles and see their amino acid mismatches.")
     input('Press ENTER to exit')
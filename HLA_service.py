@@ -0,0 +1,262 @@
+import asyncio
+import argparse
+import json
+import os
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs, urlencode
+from urllib.request import urlopen
+from urllib.error import HTTPError
+import HLA_retriever
+import HLA_sim_mat
+
+
+class SimilarityService:
+    '''
+    Keeps the HLA database, the G/P groups and the cluster dictionaries loaded, so that similarity queries can be answered
+    without reloading everything as HLA_sim_mat.py and Alignment.py do. Similarities already computed are kept in an LRU
+    cache. New ones are collected for a short while, then sent in batches to a pool of worker processes since the
+    alignments are CPU-heavy, with pairs already being computed shared between requests.
+    Nearest alleles of a whole locus are found from the reference-coordinate index where possible, and refused if they
+    would still need more than max_alignments alignments.
+    '''
+    def __init__(self, workers=None, cache_size=100000, batch_size=64, batch_wait=0.005, max_alignments=200,
+                 frame_block=256):
+        dname = os.path.dirname(os.path.abspath(__file__))
+        self.HLA_dict = HLA_sim_mat.HLA_dict #the same lazily read dictionary as the worker processes
+        self.frames = HLA_sim_mat.frames
+        with open("{}/databases/HLA_groups.txt".format(dname)) as json_file:
+            self.groups = json.load(json_file)
+        self.clusters = {}
+        for name in ('MHCI', 'MHCII'):
+            with open("{}/databases/{}_clusters.txt".format(dname, name)) as json_file:
+                self.clusters[name] = json.load(json_file)
+        self.pool = ProcessPoolExecutor(workers or os.cpu_count())
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.pending = {} #pairs waiting to be sent to, or being computed by, the worker processes
+        self.queue = []
+        self.max_alignments = max_alignments
+        self.residues = set(residue for pair in HLA_sim_mat.matrix for residue in pair)
+        self.frame_block = frame_block
+
+    def close(self):
+        self.pool.shutdown()
+
+    def check(self, *alleles):
+        for allele in alleles:
+            if allele not in self.HLA_dict:
+                raise KeyError("{} cannot be found in the HLA database".format(allele))
+
+    def alignable(self, allele):
+        return set(self.HLA_dict[allele]) <= self.residues
+
+    async def similarity(self, a1, a2):
+        self.check(a1, a2)
+        key = tuple(sorted((a1, a2)))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        for allele in (a1, a2):
+            if not self.alignable(allele):
+                raise ValueError("{} has residues missing from the substitution matrix and cannot be aligned".format(allele))
+        if key not in self.pending:
+            self.pending[key] = asyncio.get_running_loop().create_future()
+            self.queue.append(key)
+            if len(self.queue) == 1:
+                asyncio.get_running_loop().call_later(self.batch_wait, self.flush)
+            elif len(self.queue) >= self.batch_size:
+                self.flush()
+        return await asyncio.shield(self.pending[key])
+
+    def flush(self):
+        for i in range(0, len(self.queue), self.batch_size):
+            asyncio.ensure_future(self.compute(self.queue[i:i + self.batch_size]))
+        self.queue = []
+
+    async def compute(self, keys):
+        pairs = [(self.HLA_dict[a1], self.HLA_dict[a2]) for a1, a2 in keys]
+        try:
+            sims = await asyncio.get_running_loop().run_in_executor(self.pool, HLA_sim_mat.batch_similarity, pairs)
+        except Exception as e:
+            for key in keys:
+                self.pending.pop(key).set_exception(e)
+            return
+        for key, sim in zip(keys, sims):
+            self.remember(key, sim)
+            self.pending.pop(key).set_result(sim)
+
+    def remember(self, key, sim):
+        self.cache[key] = sim
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def candidates(self, allele, scope):
+        locus = allele.split('*')[0] + '*'
+        if scope == 'locus':
+            names = self.HLA_dict
+        else:
+            names = [name for clusters in self.clusters.values() for name in clusters]
+        return [name for name in names if name.startswith(locus) and name != allele]
+
+    async def frame_similarities(self, allele, names, n):
+        '''
+        Similarities of allele to the candidates on the same reference frame, from their gapless scores, computed in
+        blocks by the worker processes. Returns the similarities that are certain, and the candidates that still need to
+        be aligned: those off the frame, and those that are not certain but could be among the n most similar.
+        '''
+        try:
+            found = self.frames.locate(allele)
+        except FileNotFoundError: #no up-to-date reference-coordinate index, so every candidate is aligned
+            return {}, names
+        if found is None or found[2] != HLA_retriever.ON_FRAME:
+            return {}, names
+        rows, codes, markers = self.frames.load()[found[0]]
+        on_frame = [name for name in names if name in rows and markers[rows[name]] == HLA_retriever.ON_FRAME]
+        blocks = [on_frame[i:i + self.frame_block] for i in range(0, len(on_frame), self.frame_block)]
+        results = await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(
+            self.pool, HLA_sim_mat.frame_similarity, found[1], codes[[rows[name] for name in block]])
+            for block in blocks])
+        known, bounds = {}, {}
+        for block, (sims, certain, bound) in zip(blocks, results):
+            for name, sim, sure, most in zip(block, sims.tolist(), certain.tolist(), bound.tolist()):
+                if sure:
+                    known[name] = sim
+                    self.remember(tuple(sorted((allele, name))), sim)
+                else:
+                    bounds[name] = most
+        threshold = sorted(known.values(), reverse=True)[n - 1] if len(known) >= n else -np.inf
+        aligned = set(on_frame)
+        return known, [name for name in names if name not in aligned or
+                       (name in bounds and not bounds[name] <= threshold)] #nan bounds are aligned as well
+
+    async def nearest(self, allele, n=5, scope='clusters'):
+        '''
+        Returns the n most similar alleles of the same locus, either from the clustered alleles(scope 'clusters') or from
+        the whole HLA database(scope 'locus'). Alleles that cannot be aligned are left out of the whole database.
+        '''
+        self.check(allele)
+        names = self.candidates(allele, scope)
+        known = {}
+        if scope == 'locus':
+            known, names = await self.frame_similarities(allele, names, n)
+            names = [name for name in names if self.alignable(name)]
+            if len(names) > self.max_alignments:
+                raise ValueError("Finding the alleles nearest to {} in its locus needs {} alignments, more than the "
+                                 "limit of {}. Use scope=clusters instead.".format(allele, len(names), self.max_alignments))
+        sims = await asyncio.gather(*[self.similarity(allele, name) for name in names])
+        known.update(zip(names, sims))
+        ranked = sorted(known.items(), key=lambda x: x[1], reverse=True)
+        return [{'allele': name, 'similarity': sim} for name, sim in ranked[:n]]
+
+    def cluster(self, allele):
+        for name, clusters in self.clusters.items():
+            if allele in clusters:
+                return {'allele': allele, 'class': name, 'cluster': clusters[allele]}
+        raise KeyError("{} is not a member of any cluster".format(allele))
+
+    def validate(self, allele):
+        '''
+        Same check as in HLA_typecheck.py, giving the G/P groups as suggestions when the allele is a grouped allele.
+        '''
+        if allele in self.HLA_dict:
+            return {'allele': allele, 'valid': True, 'suggestions': []}
+        return {'allele': allele, 'valid': False, 'suggestions': self.groups.get(allele, [])}
+
+    async def handle(self, path, params):
+        def param(name, default=None):
+            if name in params:
+                return params[name][0]
+            if default is None:
+                raise ValueError("Missing parameter '{}'".format(name))
+            return default
+
+        if path == '/similarity':
+            a1, a2 = param('a'), param('b')
+            return {'a': a1, 'b': a2, 'similarity': await self.similarity(a1, a2)}
+        if path == '/nearest':
+            return await self.nearest(param('allele'), int(param('n', 5)), param('scope', 'clusters'))
+        if path == '/cluster':
+            return self.cluster(param('allele'))
+        if path == '/validate':
+            return self.validate(param('allele'))
+        raise LookupError("Unknown endpoint '{}'".format(path))
+
+
+async def respond(service, reader, writer):
+    '''
+    Answers a single HTTP GET request with a JSON body, e.g. GET /similarity?a=A*01:01:01G&b=A*02:01:01G
+    '''
+    try:
+        request = (await reader.readline()).decode().split()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if len(request) < 2:
+            return
+        url = urlsplit(request[1])
+        try:
+            status, body = '200 OK', await service.handle(url.path, parse_qs(url.query))
+        except LookupError as e:
+            status, body = '404 Not Found', {'error': e.args[0] if isinstance(e, KeyError) and e.args else str(e)}
+        except ValueError as e:
+            status, body = '400 Bad Request', {'error': str(e)}
+        except Exception as e: #e.g. a worker process that died(BrokenProcessPool), so the client still gets an answer
+            status, body = '500 Internal Server Error', {'error': '{}: {}'.format(type(e).__name__, e)}
+        data = json.dumps(body).encode()
+        writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                     .format(status, len(data)).encode() + data)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(service, host='127.0.0.1', port=8765, unix=None):
+    handler = lambda reader, writer: respond(service, reader, writer)
+    if unix:
+        server = await asyncio.start_unix_server(handler, unix)
+        print("Similarity service listening on {}".format(unix))
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        print("Similarity service listening on http://{}:{}".format(host, port))
+    async with server:
+        await server.serve_forever()
+
+
+def query(endpoint, url='http://127.0.0.1:8765', **params):
+    '''
+    Small client for notebooks and other scripts, e.g. query('similarity', a='A*01:01:01G', b='A*02:01:01G'). Errors
+    answered by the service are raised with its message: LookupError for unknown alleles and endpoints(404), ValueError
+    for bad parameters(400) and RuntimeError otherwise.
+    '''
+    try:
+        with urlopen('{}/{}?{}'.format(url, endpoint, urlencode(params))) as response:
+            return json.load(response)
+    except HTTPError as e:
+        try:
+            message = json.load(e)['error']
+        except (ValueError, KeyError, TypeError):
+            message = e.reason
+        errors = {404: LookupError, 400: ValueError}
+        raise errors.get(e.code, RuntimeError)(message) from None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local HLA similarity query service.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help="path of a Unix socket to listen on instead of host and port")
+    parser.add_argument('--workers', type=int, help="number of worker processes for alignments")
+    parser.add_argument('--cache-size', type=int, default=100000)
+    parser.add_argument('--max-alignments', type=int, default=200,
+                        help="most alignments a /nearest query of a whole locus may need")
+    args = parser.parse_args()
+    service = SimilarityService(args.workers, args.cache_size, max_alignments=args.max_alignments)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        print("Quitting.")
+    finally:
+        service.close()
@@ -1,63 +1,147 @@
 from Bio import pairwise2 as p
 from Bio.SubsMat.MatrixInfo import blosum100 as blosum100
-import seaborn as sns
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import os
-import json
 import sys
+import time
 import multiprocessing as mp
+import HLA_profiler
+import HLA_retriever
 
-#HLA allele amino acid sequences gotten from HLA_retriever.py
-try:
-    with open("{}/databases/HLA_alleles.txt".format(os.path.dirname(__file__))) as json_file:
-        HLA_dict = json.load(json_file)
-except FileNotFoundError:
+#HLA allele amino acid sequences gotten from HLA_retriever.py, read from the file when first looked up
+if not os.path.exists("{}/databases/HLA_alleles.txt".format(os.path.dirname(__file__))):
     print("Please ensure 'HLA_alleles.txt' is in the databases folder.")
-    raise
+    raise FileNotFoundError("HLA_alleles.txt")
+HLA_dict = HLA_retriever.AlleleStore("{}/databases/HLA_alleles.txt".format(os.path.dirname(__file__)))
 
 mhcI, mhcI_ca, mhcII, mhcII_ca = ([] for i in range(4)) #dataframe column names used later for easier selection of columns
 matrix = blosum100 #substitution matrix used for calculation of similarity between two MHC alleles
+gap_open, gap_extend = -10, -0.5 #gap penalties of the global alignments
+frames = HLA_retriever.FrameIndex("{0}/databases/HLA_frames.npz".format(os.path.dirname(__file__)),
+                                 "{0}/databases/HLA_alleles.txt".format(os.path.dirname(__file__)))
 
-def sim_calc(types, i, j):
+def sim_calc(types, i, j, gapless=True):
     """
     Calculation of similarity between two alleles, as seen in Alignment.py, will be used in similarity matrix creation of
     MHC I and MHC II alleles. Returns a tuple containing the indexes for the types and the similarity value, for unpacking
     into the similarity matrix later in the function "fill()". Had to be implemented this way due to multiprocessing.
     """
-    a1 = HLA_dict[types[i]]
-    a2 = HLA_dict[types[j]]
-    alignments = p.align.globalds(a1, a2, matrix, -10, -0.5, one_alignment_only=True)[0]
-    length = alignments[4]
+    return (i, j, pair_similarity(HLA_dict[types[i]], HLA_dict[types[j]], gapless))
+
+
+def pair_similarity(a1, a2, gapless=True):
+    """
+    Similarity between two amino acid sequences, from the score of their global alignment (blosum100 matrix). When the
+    gapless alignment of the sequences is certain to be the best one, its score is used without doing the alignment,
+    unless gapless is False.
+    """
+    score = HLA_retriever.gapless_score(a1, a2, matrix, gap_open, gap_extend) if gapless else None
+    if score is None:
+        alignments = p.align.globalds(a1, a2, matrix, gap_open, gap_extend, one_alignment_only=True)[0]
+        score, length = alignments[2], alignments[4]
+    else:
+        length = len(a1)
     max = 17 * length
-    sim = 1 - ((max - alignments[2]) / max)
-    return (i, j, sim)
+    return 1 - ((max - score) / max)
+
+
+def batch_similarity(pairs):
+    """
+    pair_similarity for a list of (sequence, sequence) tuples, so that many pairs can be sent to a worker process at once.
+    """
+    return [pair_similarity(a1, a2) for a1, a2 in pairs]
 
 
-def fill(arr, type_list):
+def frame_fill(arr, type_list, block=4096):
+    """
+    Fills in the similarities of pairs of alleles that lie on their locus' reference frame(see
+    HLA_retriever.build_frames) without deletions, from the position by position blosum100 scores, computed for blocks
+    of pairs at once. Loci with frames of the same width(HLA-A, HLA-B and HLA-C, or HLA-DRB1 and HLA-DQB1) are compared
+    with each other as well. Pairs whose gapless alignment is not certain to be the best one are left out. Returns a
+    boolean matrix of the pairs filled in, which is all False if the reference-coordinate index is missing or out of
+    date.
+    """
+    done = np.zeros(arr.shape, dtype=bool)
+    try:
+        frames.load()
+    except FileNotFoundError:
+        return done
+    table = HLA_retriever.score_table(matrix)
+    widths = {}
+    for k, name in enumerate(type_list):
+        found = frames.locate(name)
+        if found is not None and found[2] == HLA_retriever.ON_FRAME:
+            widths.setdefault(len(found[1]), []).append((k, found[1]))
+    for members in widths.values():
+        index = np.array([k for k, codes in members])
+        codes = np.array([codes for k, codes in members])
+        max = 17 * codes.shape[1]
+        first, second = np.triu_indices(len(index)) #similarity is symmetric, so each pair is only scored once
+        for b in range(0, len(first), block):
+            a1, a2 = first[b:b + block], second[b:b + block]
+            scores, certain = HLA_retriever.gapless_scores(codes[a1], codes[a2], table, gap_open, gap_extend)
+            i, j = index[a1[certain]], index[a2[certain]]
+            arr[i, j] = arr[j, i] = 1 - ((max - scores[certain]) / max)
+            done[i, j] = done[j, i] = True
+    HLA_profiler.count("gapless pairs", int(done.sum()))
+    return done
+
+
+def frame_similarity(codes, others):
+    """
+    Similarities of one allele to others on the same reference frame(given as residue codes), from their gapless scores.
+    Also returns whether each similarity is certain, and for the ones that are not, an upper bound of the similarity
+    found by aligning them: no alignment with gaps scores more than HLA_retriever.gapped_scores or is shorter than the
+    frame.
+    """
+    table = HLA_retriever.score_table(matrix)
+    first = np.repeat(codes[None, :], len(others), axis=0)
+    scores = table[first, others].sum(axis=1)
+    gapped = HLA_retriever.gapped_scores(first, others, table, gap_open, gap_extend)
+    with np.errstate(invalid='ignore'):
+        certain = scores > gapped
+    max = 17 * len(codes)
+    return 1 - ((max - scores) / max), certain, np.fmax(scores, np.maximum(gapped, 0)) / max
+
+def fill(arr, type_list, name="fill", workers=None):
     """
     Used to fill in values for similarity matrix creation using similarity value calculated by the function sim_calc.
-    Since the calculations are CPU-heavy, uses multiprocessing to take advantage of additional CPU cores.
+    Since the calculations are CPU-heavy, uses multiprocessing to take advantage of additional CPU cores(all of them,
+    unless a number of workers is given).
+    Pairs of alleles on the same reference frame are filled in by frame_fill first, so only the remaining pairs are
+    aligned. The time taken by each alignment and the use of the pool are recorded under name in the run report.
     """
-    result = []
-    pool = mp.Pool(mp.cpu_count())
-    for i in range(len(type_list)):
-        for j in range(len(type_list)):
-            res = pool.apply_async(sim_calc, (type_list, i, j))
-            result.append(res)
-    for res in result:
-        i, j, sim = res.get()
-        arr[i][j] = sim
-    pool.terminate()
+    result, tasks = [], []
+    workers = workers or mp.cpu_count()
+    with HLA_profiler.timer("{} gapless".format(name)):
+        done = frame_fill(arr, type_list)
+    start = time.perf_counter()
+    with HLA_profiler.sampling(name):
+        pool = mp.Pool(workers)
+        for i in range(len(type_list)):
+            for j in range(len(type_list)):
+                if done[i][j]:
+                    continue
+                res = pool.apply_async(HLA_profiler.timed_call, (sim_calc, type_list, i, j, False))
+                result.append(res)
+        for res in result:
+            task = res.get()
+            i, j, sim = task[0]
+            arr[i][j] = sim
+            tasks.append(task)
+        pool.terminate()
+    HLA_profiler.record_pool(name, tasks, time.perf_counter() - start, workers)
 
 def run():
     """
     Main method that does dataframe manipulation to build similarity matrices to be later used for spectral embedding and GMM clustering.
     """
+    import pandas as pd #only needed here, so that the similarity functions can be imported without it
+    import HLA_visualiser
     # loads the excel spreadsheet file containing HLA types of donors and replaces missing with nan
     try:
-        types = pd.read_excel("{}/spreadsheets/types.xlsx".format(os.path.dirname(__file__))).replace("n.t.", np.nan)
+        with HLA_profiler.timer("read types.xlsx"):
+            types = pd.read_excel("{}/spreadsheets/types.xlsx".format(os.path.dirname(__file__))).replace("n.t.", np.nan)
     except FileNotFoundError:
         print("Please ensure 'types.xlsx' is in the spreadsheets folder.")
         raise
@@ -105,39 +189,36 @@ def run():
 
     #fills up the similarity matrices using allele similarity calculated by global alignment of the two sequences(scores calculated by blosum100 matrix)
     print("Forming similarity matrix for MHC alleles. The computation might take a while, please wait.")
-    fill(sim_matrix, types)
+    fill(sim_matrix, types, "fill MHC I")
     print("MHC I alleles similarity matrix done...now computing MHC II alleles similarity matrix.")
-    fill(sim_matrix2, types2)
+    fill(sim_matrix2, types2, "fill MHC II")
     print("MHC II alleles similarity matrix done.")
 
     #exports to excel spreadsheets
     sim_matrix = pd.DataFrame(data = sim_matrix, index = types, columns = types)
     sim_matrix2 = pd.DataFrame(data = sim_matrix2, index = types2, columns = types2)
 
-    writer = pd.ExcelWriter('sim_matrix.xlsx')
-
-    sim_matrix.to_excel(writer,'MHC I')
-    sim_matrix2.to_excel(writer,'MHC II')
+    with HLA_profiler.timer("write sim_matrix.xlsx"):
+        writer = pd.ExcelWriter('sim_matrix.xlsx')
 
-    writer.save()
+        sim_matrix.to_excel(writer,'MHC I')
+        sim_matrix2.to_excel(writer,'MHC II')
 
-    #creation of MHC allele similarity heatmaps
-    datamhcI = pd.read_excel("sim_matrix.xlsx", index_col=0)
-    datamhcII = pd.read_excel("sim_matrix.xlsx", 1, index_col=0)
+        writer.save()
 
-    os.chdir("{}/output/cluster_data".format(os.path.dirname(__file__)))
+    #binary copies of the similarity matrices, which are used to render them(and can be read faster than Excel files)
+    HLA_visualiser.save_matrix("MHCI", sim_matrix.values, types)
+    HLA_visualiser.save_matrix("MHCII", sim_matrix2.values, types2)
 
-    #creates and saves heatmaps of similarity matrices into ~/output/cluster_data
-    sns.set()
-    ax = sns.heatmap(datamhcI.values)
-    plt.savefig("mhcI_heatmap.png")
-    plt.close()
-    ax2 = sns.heatmap(datamhcII.values)
-    plt.savefig("mhcII_heatmap.png")
-    plt.close()
+    #creates and saves heatmaps of similarity matrices into ~/output/cluster_data, with alleles ordered by seriation since
+    #they have not been clustered yet. HLA_visualiser.py can render them ordered by cluster afterwards.
+    with HLA_profiler.timer("heatmaps"):
+        HLA_visualiser.run(order='seriation')
 
 if __name__ == '__main__':
-    run()
-    print("Similarity matrices creation successful. They have been saved in the ~/database/sim_matrix folder. Heatmaps of the similarity matrices can also be found in this folder.")
+    with HLA_profiler.profile("HLA_sim_mat"):
+        run()
+    HLA_profiler.report("HLA_sim_mat")
+    print("Similarity matrices creation successful. They have been saved in the ~/database/sim_matrix folder. Heatmaps of the similarity matrices can be found in the ~/output/cluster_data folder.")
     print("Please proceed to HLA_clusterer.py for clustering of HLA alleles.")
     input('Press ENTER to exit')
\ No newline at end of file
@@ -0,0 +1,224 @@
+'''
+Visualisation of the similarity matrices. Rows and columns are reordered by cluster membership(MHCI_clusters.txt and
+MHCII_clusters.txt) or by spectral seriation, and the matrix is reduced block by block(mean or max) to a fixed number of
+pixels, reading it from a memory-mapped binary copy a few rows at a time. Memory used therefore depends on the size of
+the picture rather than on the size of the matrix. A zoomable pyramid of 256 x 256 tiles can also be written.
+'''
+
+import argparse
+import json
+import math
+import os
+import numpy as np
+import HLA_profiler
+
+dname = os.path.dirname(os.path.abspath(__file__))
+sheets = {'MHCI': 0, 'MHCII': 1} #sheets of sim_matrix.xlsx
+tile_size = 256
+
+
+def matrix_paths(name):
+    return ("{}/databases/sim_matrix/{}_matrix.npy".format(dname, name),
+            "{}/databases/sim_matrix/{}_names.txt".format(dname, name))
+
+
+def save_matrix(name, matrix, names):
+    '''
+    Saves a similarity matrix as a binary .npy file, with the allele names in a .json file next to it.
+    '''
+    matrix_path, names_path = matrix_paths(name)
+    np.save(matrix_path, np.asarray(matrix, dtype=np.float64))
+    with open(names_path, 'w') as outfile:
+        json.dump(list(names), outfile)
+
+
+def load_matrix(name):
+    '''
+    Opens the binary similarity matrix memory-mapped, so that only the rows used are read. If there is none yet, or
+    sim_matrix.xlsx has been changed since it was made, it is made from sim_matrix.xlsx.
+    '''
+    matrix_path, names_path = matrix_paths(name)
+    excel_path = "{}/databases/sim_matrix/sim_matrix.xlsx".format(dname)
+    if not os.path.exists(matrix_path) or not os.path.exists(names_path) or \
+            os.path.exists(excel_path) and os.path.getmtime(excel_path) > os.path.getmtime(matrix_path):
+        import pandas as pd
+        df = pd.read_excel(excel_path, sheets[name], index_col=0)
+        save_matrix(name, df.values, df.index)
+    with open(names_path) as json_file:
+        names = json.load(json_file)
+    return np.load(matrix_path, mmap_mode='r'), names
+
+
+def cluster_order(name, names):
+    '''
+    Orders alleles by their cluster, then by name. Alleles without a cluster are placed last. Returns the order and the
+    positions in it where a new cluster starts.
+    '''
+    with open("{}/databases/{}_clusters.txt".format(dname, name)) as json_file:
+        clusters = json.load(json_file)
+    last = max(clusters.values()) + 1 if clusters else 0
+    labels = [clusters.get(allele, last) for allele in names]
+    order = np.array(sorted(range(len(names)), key=lambda k: (labels[k], names[k])), dtype=np.intp)
+    ordered = np.array(labels)[order]
+    return order, np.flatnonzero(ordered[1:] != ordered[:-1]) + 1
+
+
+def seriation_order(matrix, budget=2 ** 22, tol=1e-8):
+    '''
+    Spectral seriation: orders alleles by the first non-trivial eigenvector of the normalised Laplacian(the coordinate
+    HLA_clusterer's spectral embedding gives them in one dimension), so that similar alleles end up next to each other.
+    The eigenvector is found with Lanczos iterations, which only multiply the matrix by a vector, reading it in chunks of
+    rows holding at most budget values, so the matrix is never loaded whole.
+    '''
+    from scipy.sparse.linalg import LinearOperator, eigsh
+    n = len(matrix)
+    if n < 3:
+        return np.arange(n), np.array([], dtype=int)
+    chunk = max(1, budget // n)
+    diagonal, degree = np.empty(n), np.empty(n)
+    for row in range(0, n, chunk): #self-similarities are left out of the graph, as in the Laplacian of HLA_clusterer
+        rows = np.arange(row, min(row + chunk, n))
+        block = np.asarray(matrix[row:rows[-1] + 1], dtype=np.float64)
+        diagonal[rows] = block[rows - row, rows]
+        degree[rows] = block.sum(axis=1) - diagonal[rows]
+    scale = 1 / np.sqrt(degree)
+
+    def product(x): #D^-1/2 W D^-1/2 x, whose largest eigenvalues are 1 - those of the normalised Laplacian
+        x = np.ravel(x) * scale
+        y = np.empty(n)
+        for row in range(0, n, chunk):
+            block = np.asarray(matrix[row:row + chunk], dtype=np.float64)
+            y[row:row + len(block)] = block @ x - diagonal[row:row + len(block)] * x[row:row + len(block)]
+        return y * scale
+
+    values, vectors = eigsh(LinearOperator((n, n), matvec=product, dtype=np.float64), k=2, which='LA', tol=tol,
+                            v0=np.random.RandomState(0).rand(n)) #fixed start, so the order is the same every time
+    vector = vectors[:, np.argmin(values)] * scale #the trivial eigenvector has the largest eigenvalue
+    vector *= np.sign(vector[np.argmax(np.abs(vector))]) #same sign as sklearn gives
+    return np.argsort(vector, kind='stable'), np.array([], dtype=int)
+
+
+def pixel_bins(n, size):
+    '''
+    Start of every pixel in the n rows(or columns), when n is reduced to size pixels.
+    '''
+    return np.searchsorted((np.arange(n) * size) // n, np.arange(size))
+
+
+def downsample(matrix, order, size, how='mean', band=None, budget=2 ** 22):
+    '''
+    Reduces the reordered matrix to size x size pixels, taking the mean or max of each block of the matrix. Yields bands
+    of band pixel rows(all of them at once by default) along with the first pixel row of each band. The matrix is read
+    in chunks of rows holding at most budget values.
+    '''
+    n = len(order)
+    size = min(size, n)
+    band = band or size
+    starts = pixel_bins(n, size)
+    counts = np.diff(np.append(starts, n))
+    reduce = np.maximum.reduceat if how == 'max' else np.add.reduceat
+    chunk = max(1, budget // n)
+    for first in range(0, size, band):
+        last = min(first + band, size)
+        end = starts[last] if last < size else n
+        image = np.full((last - first, size), -np.inf if how == 'max' else 0.0)
+        for row in range(starts[first], end, chunk):
+            rows = np.arange(row, min(row + chunk, end))
+            block = reduce(np.asarray(matrix[order[rows]])[:, order], starts, axis=1)
+            pixels = (rows * size) // n - first
+            if how == 'max':
+                np.maximum.at(image, pixels, block)
+            else:
+                np.add.at(image, pixels, block)
+        if how != 'max':
+            image /= counts[first:last, None] * counts[None, :]
+        yield first, image
+
+
+def value_range(matrix, budget=2 ** 22):
+    '''
+    Smallest and largest similarity in the matrix, read in chunks of rows holding at most budget values. Every pixel of
+    a downsampled image(mean or max of a block) lies in this range.
+    '''
+    chunk = max(1, budget // max(1, len(matrix)))
+    low, high = np.inf, -np.inf
+    for row in range(0, len(matrix), chunk):
+        block = np.asarray(matrix[row:row + chunk])
+        low, high = min(low, np.nanmin(block)), max(high, np.nanmax(block))
+    return low, high
+
+
+def render(name, order='clusters', size=1024, how='mean', filename=None):
+    '''
+    Saves a picture of a similarity matrix of at most size x size pixels, with rows and columns ordered by cluster
+    ('clusters', with lines between clusters), by spectral seriation('seriation') or as they are('none').
+    '''
+    matrix, names = load_matrix(name)
+    with HLA_profiler.timer("order {}".format(name)):
+        if order == 'clusters':
+            index, boundaries = cluster_order(name, names)
+        elif order == 'seriation':
+            index, boundaries = seriation_order(matrix)
+        else:
+            index, boundaries = np.arange(len(names)), np.array([], dtype=int)
+    with HLA_profiler.timer("downsample {}".format(name)):
+        image = next(downsample(matrix, index, size, how))[1]
+    import matplotlib.pyplot as plt
+    with HLA_profiler.timer("render {}".format(name)):
+        fig = plt.figure(figsize=(8, 8), dpi=max(100, image.shape[0] // 8))
+        ax = fig.add_axes([0.05, 0.05, 0.85, 0.9])
+        shown = ax.imshow(image, cmap='viridis', interpolation='nearest', extent=(0, len(names), len(names), 0))
+        for boundary in boundaries:
+            ax.axhline(boundary, color='white', linewidth=0.5)
+            ax.axvline(boundary, color='white', linewidth=0.5)
+        ax.set_title('{} similarity matrix, {} alleles ordered by {}'.format(name, len(names), order))
+        fig.colorbar(shown, cax=fig.add_axes([0.92, 0.05, 0.02, 0.9]))
+        fig.savefig(filename or "{}/output/cluster_data/{}_heatmap.png".format(dname, name.replace('MHC', 'mhc')))
+        plt.close(fig)
+
+
+def tiles(name, order='clusters', how='mean', levels=None, folder=None):
+    '''
+    Writes a zoomable pyramid of tile_size x tile_size tiles as folder/level/row_column.png. Level 0 is one tile for
+    the whole matrix, and each level doubles the resolution until one pixel is one pair of alleles(or levels is reached).
+    '''
+    import matplotlib.pyplot as plt
+    matrix, names = load_matrix(name)
+    index = cluster_order(name, names)[0] if order == 'clusters' else \
+        seriation_order(matrix)[0] if order == 'seriation' else np.arange(len(names))
+    folder = folder or "{}/output/cluster_data/tiles/{}".format(dname, name)
+    top = max(0, math.ceil(math.log2(len(names) / tile_size)))
+    vmin, vmax = value_range(matrix) #same colour scale on every level and tile
+    for level in range(min(top, levels if levels is not None else top) + 1):
+        os.makedirs("{}/{}".format(folder, level), exist_ok=True)
+        with HLA_profiler.timer("tiles level {}".format(level)):
+            for first, image in downsample(matrix, index, tile_size * 2 ** level, how, band=tile_size):
+                for column in range(0, image.shape[1], tile_size):
+                    plt.imsave("{}/{}/{}_{}.png".format(folder, level, first // tile_size, column // tile_size),
+                               image[:, column:column + tile_size], cmap='viridis', vmin=vmin, vmax=vmax)
+                    HLA_profiler.count("tiles written")
+    return folder
+
+
+def run(order='clusters', size=1024, how='mean', pyramid=False):
+    '''
+    Renders both similarity matrices into ~/output/cluster_data, and writes their tile pyramids if pyramid is True.
+    '''
+    os.makedirs("{}/output/cluster_data".format(dname), exist_ok=True)
+    for name in sheets:
+        render(name, order, size, how)
+        if pyramid:
+            tiles(name, order, how)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Renders the similarity matrices.")
+    parser.add_argument('--order', choices=['clusters', 'seriation', 'none'], default='clusters')
+    parser.add_argument('--size', type=int, default=1024, help="largest number of pixels per side")
+    parser.add_argument('--how', choices=['mean', 'max'], default='mean', help="how blocks of the matrix are reduced")
+    parser.add_argument('--tiles', action='store_true', help="also write a zoomable tile pyramid")
+    args = parser.parse_args()
+    with HLA_profiler.profile("HLA_visualiser"):
+        run(args.order, args.size, args.how, args.tiles)
+    HLA_profiler.report("HLA_visualiser")
+    print("Heatmaps of the similarity matrices have been saved in the ~/output/cluster_data folder.")
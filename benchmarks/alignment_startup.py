@@ -0,0 +1,54 @@
+'''
+Startup benchmark for Alignment.py. Each measurement is done in a fresh interpreter so that nothing is already imported
+or cached. "eager" repeats what Alignment.py used to do before showing the prompt (importing Bio, matplotlib and seaborn,
+creating a figure and parsing the whole HLA database), so the two can be compared directly.
+'''
+
+import subprocess
+import sys
+import os
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+snippets = {
+    "eager": """
+import json, os
+from Bio import pairwise2
+from Bio.SubsMat.MatrixInfo import blosum100
+import numpy, matplotlib.pyplot as plt, seaborn
+plt.figure(); plt.close()
+with open("databases/HLA_alleles.txt") as json_file:
+    json.load(json_file)
+""",
+    "startup": """
+from Alignment import Alignment
+Alignment()
+""",
+    "setboth": """
+from Alignment import Alignment
+prompt = Alignment()
+prompt.do_setboth("A*01:01:01G A*02:01:01G")
+""",
+}
+
+
+def measure(snippet, repeats):
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-W", "ignore", "-c", snippet], cwd=root, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(repeats=5):
+    results = {name: measure(snippet, repeats) for name, snippet in snippets.items()}
+    for name, seconds in results.items():
+        print("{:<10}{:>8.3f} s".format(name, seconds))
+    print("Startup is {:.1f}x faster than loading everything eagerly.".format(results["eager"] / results["startup"]))
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
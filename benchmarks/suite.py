@@ -0,0 +1,255 @@
+'''
+Benchmark suite for the alignment, similarity matrix, clustering and Correspondence Analysis stages. Synthetic cohorts are
+made by sampling real alleles(and their sequences) from databases/HLA_alleles.txt and the cluster dictionaries, with a
+fixed seed so that runs can be compared. Results can be saved as a baseline and later runs compared against it, with
+any case slower than the threshold counted as a regression. Each result is printed as soon as it is measured, and the
+ones measured are still saved or compared if a later benchmark fails.
+
+Peak memory is the memory allocated by Python during one call(tracemalloc), except for fill, whose work is done in
+worker processes: there it is the highest memory resident in the process and its pool while filling(HLA_profiler).
+
+The correctness check recomputes pairs of the reference matrices in databases/sim_matrix/sim_matrix.xlsx and compares
+every fast path registered in fast_paths against aligning every pair with sim_calc, within a tolerance.
+
+Example usage: 'python benchmarks/suite.py --sizes 10 20 --workers 1 2 --save' and later 'python benchmarks/suite.py --compare'
+'''
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+import pandas as pd
+import HLA_profiler
+import HLA_sim_mat
+import HLA_clusterer
+
+baseline_file = "{}/benchmarks/baselines.json".format(root)
+mhcI_loci = ("A", "B", "C")
+
+def fill_matrix(types):
+    arr = np.zeros((len(types), len(types)))
+    HLA_sim_mat.fill(arr, types)
+    return arr
+
+
+#faster ways of filling a similarity matrix, as functions taking a list of allele names and returning the matrix
+fast_paths = {"fill": fill_matrix}
+
+
+def sample_alleles(n, seed, loci=mhcI_loci):
+    '''
+    Samples n alleles of the given loci, leaving out the ones with residues missing from the substitution matrix(such
+    as '-'), which cannot be aligned.
+    '''
+    residues = set(residue for pair in HLA_sim_mat.matrix for residue in pair)
+    rng = random.Random(seed)
+    names = sorted(name for name in HLA_sim_mat.HLA_dict
+                   if name.split('*')[0] in loci and set(HLA_sim_mat.HLA_dict[name]) <= residues)
+    return rng.sample(names, n)
+
+
+def synthetic_matrix(n, seed):
+    '''
+    An n x n similarity matrix made by resampling the alleles of the reference MHC I matrix, with a little noise added so
+    that repeated alleles are not identical.
+    '''
+    reference = pd.read_excel("{}/databases/sim_matrix/sim_matrix.xlsx".format(root), index_col=0).values
+    rng = np.random.RandomState(seed)
+    index = rng.choice(len(reference), n)
+    noise = rng.normal(0, 0.002, (n, n))
+    return np.abs(reference[index][:, index] + (noise + noise.T) / 2)
+
+
+def synthetic_cohort(n, seed, antigen="cd8_synthetic"):
+    '''
+    A cluster-mapped dataframe as prepared by CA.prepare, with random binned responses to one antigen and two MHC I alleles
+    per locus sampled from MHCI_clusters.txt for each donor.
+    '''
+    import CA
+    rng = random.Random(seed)
+    names = sorted(CA.clusters)
+    df = pd.DataFrame({antigen: [rng.choice(CA.labels) for i in range(n)]})
+    columns = []
+    for locus in mhcI_loci:
+        members = [name for name in names if name.startswith(locus + '*')]
+        for k in ('1', '2'):
+            column = '{}.{}'.format(locus, k)
+            df[column] = [str(CA.clusters[rng.choice(members)]) for i in range(n)]
+            columns.append(column)
+    return df, [antigen] + columns
+
+
+def measure(function, repeats, memory=True):
+    '''
+    Returns the fastest of repeats calls of function, and the peak memory(MB) allocated during one more call.
+    '''
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return min(timings), peak
+
+
+def add_result(results, name, result):
+    results[name] = result
+    print("{:<32}{:>12.4f}{:>14.1f}{:>10}".format(name, result["seconds"], result["throughput"],
+                                                 "-" if result["peak_mb"] is None else
+                                                 "{:.1f}".format(result["peak_mb"])), flush=True)
+
+
+def bench_sim_calc(args, results):
+    types = sample_alleles(args.pairs + 1, args.seed)
+    seconds, peak = measure(lambda: [HLA_sim_mat.sim_calc(types, 0, j) for j in range(1, len(types))],
+                            args.repeats, args.memory)
+    add_result(results, "sim_calc", {"seconds": seconds / args.pairs, "throughput": args.pairs / seconds,
+                                     "unit": "pairs/s", "peak_mb": peak})
+
+
+def bench_fill(args, results):
+    for n in args.sizes:
+        types = sample_alleles(n, args.seed)
+        for workers in args.workers:
+            arr = np.zeros((n, n))
+            name = "fill n={} workers={}".format(n, workers)
+            seconds, peak = measure(lambda: HLA_sim_mat.fill(arr, types, workers=workers), args.repeats, False)
+            if args.memory:
+                with HLA_profiler.sampling(name):
+                    HLA_sim_mat.fill(arr, types, workers=workers)
+                peak = HLA_profiler.memory.get(name)
+            add_result(results, name, {"seconds": seconds, "throughput": n * n / seconds, "unit": "pairs/s",
+                                       "peak_mb": peak})
+
+
+def bench_cluster(args, results):
+    for n in args.cluster_sizes:
+        data = synthetic_matrix(n, args.seed)
+        seconds, peak = measure(lambda: HLA_clusterer.cluster(data, 5, 8), args.repeats, args.memory)
+        add_result(results, "cluster n={}".format(n), {"seconds": seconds, "throughput": n / seconds,
+                                                       "unit": "alleles/s", "peak_mb": peak})
+
+
+def bench_ca(args, results):
+    '''
+    Times CA.correspondence, the analysis of one antigen without the graph and spreadsheet written by CA.analyse.
+    '''
+    import CA
+    df, select = synthetic_cohort(args.donors, args.seed)
+    seconds, peak = measure(lambda: CA.correspondence(select, df), args.repeats, args.memory)
+    add_result(results, "CA.correspondence donors={}".format(args.donors),
+               {"seconds": seconds, "throughput": 1 / seconds, "unit": "antigens/s", "peak_mb": peak})
+
+
+def check(args, tolerance=1e-9):
+    '''
+    Returns a list of failures: pairs of the reference matrices that sim_calc no longer reproduces, and fast paths whose
+    matrices differ from the ones made by aligning every pair.
+    '''
+    failures = []
+    rng = random.Random(args.seed)
+    for sheet in (0, 1):
+        reference = pd.read_excel("{}/databases/sim_matrix/sim_matrix.xlsx".format(root), sheet, index_col=0)
+        types = list(reference.index)
+        for k in range(args.check_pairs):
+            i, j = rng.randrange(len(types)), rng.randrange(len(types))
+            sim = HLA_sim_mat.sim_calc(types, i, j)[2]
+            if abs(sim - reference.values[i, j]) > tolerance:
+                failures.append("sim_calc {} vs {}: {} != {}".format(types[i], types[j], sim, reference.values[i, j]))
+    types = sample_alleles(min(args.sizes), args.seed)
+    expected = np.array([[HLA_sim_mat.sim_calc(types, i, j, False)[2] for j in range(len(types))]
+                         for i in range(len(types))])
+    for name, function in fast_paths.items():
+        difference = np.max(np.abs(function(types) - expected))
+        if difference > tolerance:
+            failures.append("{} differs from sim_calc by up to {}".format(name, difference))
+    return failures
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print("{:<32}{:>12}{:>12}{:>10}".format("case", "baseline", "now", "ratio"))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        print("{:<32}{:>12.4f}{:>12.4f}{:>10.2f}{}".format(name, baseline[name]["seconds"], result["seconds"], ratio,
+                                                          "  REGRESSION" if ratio > 1 + threshold else ""))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+benches = {"sim_calc": bench_sim_calc, "fill": bench_fill, "cluster": bench_cluster, "ca": bench_ca}
+
+
+def run(args):
+    results = {}
+    print("{:<32}{:>12}{:>14}{:>10}".format("case", "seconds", "throughput", "peak MB"))
+    try:
+        for name in args.only or benches:
+            benches[name](args, results)
+    finally: #results measured before a failing benchmark are still saved or compared
+        status = report(args, results)
+    return status
+
+
+def report(args, results):
+    status = 0
+    if args.check:
+        failures = check(args)
+        for failure in failures:
+            print(failure)
+        print("Correctness check {}.".format("failed" if failures else "passed"))
+        status = 1 if failures else 0
+    if args.compare:
+        with open(args.baseline) as json_file:
+            regressions = compare(results, json.load(json_file), args.threshold)
+        if regressions:
+            print("{} regression(s) over {:.0%}.".format(len(regressions), args.threshold))
+            status = 1
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline): #cases not run this time keep their earlier results
+            with open(args.baseline) as json_file:
+                baseline = json.load(json_file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as outfile:
+            json.dump(baseline, outfile, indent=1)
+        print("Baseline saved as {}".format(args.baseline))
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of the HLA workflow stages.")
+    parser.add_argument('--only', nargs='*', choices=list(benches), help="only run these benchmarks")
+    parser.add_argument('--pairs', type=int, default=50, help="number of pairs timed for sim_calc")
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10, 20, 40], help="numbers of alleles for fill")
+    parser.add_argument('--workers', type=int, nargs='*', default=sorted({1, 2, os.cpu_count()}),
+                        help="numbers of worker processes for fill")
+    parser.add_argument('--cluster-sizes', type=int, nargs='*', default=[73, 500, 2000],
+                        help="numbers of alleles for clustering")
+    parser.add_argument('--donors', type=int, default=94, help="number of donors for CA")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="do not measure peak memory")
+    parser.add_argument('--check', action='store_true', help="run the correctness check")
+    parser.add_argument('--check-pairs', type=int, default=20, help="pairs of the reference matrices to recompute")
+    parser.add_argument('--baseline', default=baseline_file)
+    parser.add_argument('--save', action='store_true', help="save the results as the baseline")
+    parser.add_argument('--compare', action='store_true', help="compare the results against the baseline")
+    parser.add_argument('--threshold', type=float, default=0.2, help="slowdown counted as a regression(0.2 = 20%%)")
+    sys.exit(run(parser.parse_args()))